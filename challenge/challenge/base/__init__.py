@@ -1,5 +1,5 @@
 from .base_data_loader import DataLoaderBase
-from .base_dataset_loader import DatasetBase
-from .base_model import ModelBase
+from .base_dataset_loader import DatasetBase, StreamingDataset, stream_batches, pad_collate
+from .base_model import ModelBase, MergedLinear
 from .base_trainer import TrainerBase, AverageMeter
 from .base_eval import EvaluateBase
\ No newline at end of file
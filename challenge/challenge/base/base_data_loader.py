@@ -1,14 +1,40 @@
 import numpy as np
+import torch
 
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import (
+    BatchSampler,
+    RandomSampler,
+    SequentialSampler,
+    SubsetRandomSampler
+)
+
+from challenge.utils import (
+    setup_logger,
+    BucketBatchSampler,
+    DistributedSubsetSampler,
+    is_distributed,
+    get_rank,
+    get_world_size
+)
+from .base_dataset_loader import StreamingDataset, pad_collate
+
+
+log = setup_logger(__name__)
 
 
 class DataLoaderBase(DataLoader):
     """ Challenge Dataloader """
 
     def __init__(self, dataset_loader: str, batch_size: int, shuffle: bool,
-                    validation_split: float, nworkers: int, test_path: list, train_path: list = None):
+                    validation_split: float, nworkers: int, test_path: list,
+                    train_path: list = None,
+                    dataset_args: dict = None, max_residues_per_batch: int = None,
+                    streaming: bool = False, shuffle_buffer: int = 1000,
+                    prefetch_factor: int = 2,
+                    persistent_workers: bool = True, pin_memory: bool = None,
+                    split_path: str = None,
+                    batch_fetch: bool = False, reuse_buffers: bool = False):
         """ Constructor
         Args:
             train_path: path to the training dataset
@@ -18,42 +44,177 @@ class DataLoaderBase(DataLoader):
             validation_split: decimal for the split of the validation
             nworkers: workers for the dataloader class
             test_path: path to the test dataset(s)
+            dataset_args: keyword arguments of the dataset loader class, eg. the storage
+            max_residues_per_batch: if set, batches proteins of similar length up to
+                this many padded residues instead of using a fixed batch size for
+                training and validation, requires the packed layout
+            streaming: streams the proteins of all training datasets from disk one shard
+                at a time instead of loading the first training dataset
+            shuffle_buffer: number of proteins shuffled together when streaming
+            prefetch_factor: batches loaded in advance by each worker
+            persistent_workers: keeps the workers alive between epochs
+            pin_memory: loads batches into pinned memory, by default with a GPU
+            split_path: split.npz saved by a previous run, reuses its training and
+                validation split instead of drawing a new one
+            batch_fetch: the sampler yields the indices of whole batches, which the
+                dataset reads with one vectorized gather instead of one __getitem__ per
+                protein
+            reuse_buffers: with batch_fetch, writes every batch into the same
+                preallocated tensors. Only possible without workers, a batch is
+                overwritten by the next one
         """
+        if reuse_buffers and not batch_fetch:
+            raise ValueError('reuse_buffers requires batch_fetch')
+        if reuse_buffers and nworkers:
+            raise ValueError('reuse_buffers is only supported without workers '
+                                '(nworkers: 0)')
+        if batch_fetch and streaming:
+            raise ValueError('batch_fetch is not supported when streaming')
+
         self.init_kwargs = {
             'batch_size': batch_size,
             'num_workers': nworkers,
-            'shuffle': shuffle
+            'shuffle': shuffle,
+            'collate_fn': pad_collate,
+            'pin_memory': (torch.cuda.is_available() if pin_memory is None
+                            else pin_memory)
         }
 
+        # only valid with worker processes
+        if nworkers:
+            self.init_kwargs.update({
+                'prefetch_factor': prefetch_factor,
+                'persistent_workers': persistent_workers
+            })
+
         self.test_path = test_path
+        self.dataset_args = dataset_args or {}
+        self.batch_fetch = batch_fetch
+        self.reuse_buffers = reuse_buffers
 
+        self.train_dataset = None
+        self.valid_dataset = None
+        self.train_sampler = None
+        self.valid_sampler = None
+
+        # without training data only the test data is used, see get_test
         if not train_path:
-            return self.get_test()
+            return
 
-        self.train_dataset = self.dataset_loader(train_path[0])
-        self.valid_dataset = self.dataset_loader(train_path[0])
+        if streaming:
+            if max_residues_per_batch:
+                raise ValueError('max_residues_per_batch is not supported when '
+                                    'streaming')
+            if is_distributed():
+                raise ValueError('Streaming is not supported in distributed runs')
+            self._stream(train_path, shuffle, shuffle_buffer, validation_split,
+                            split_path)
+            return
 
-        self.train_sampler = None
-        self.valid_sampler = None
+        # training and validation are index views of the same dataset
+        self.train_dataset = self._load_dataset(train_path[0])
+        self.valid_dataset = self.train_dataset
 
-        if validation_split:
-            self._split(validation_split)
+        # padded proteins keep their full length, so the batches would not shrink
+        if max_residues_per_batch and self.train_dataset.layout != 'packed':
+            raise ValueError('max_residues_per_batch requires the packed layout '
+                                '(layout: packed)')
+
+        if validation_split or split_path:
+            self._split(validation_split, split_path)
             self.init_kwargs.pop('shuffle')
 
-        super().__init__(self.train_dataset, sampler=self.train_sampler, **self.init_kwargs)
+        # each process of a distributed run samples its part of the same split and order
+        self.replicas = {}
+        if is_distributed():
+            self.replicas = {
+                'num_replicas': get_world_size(),
+                'rank': get_rank(),
+                'seed': int(np.random.randint(2 ** 31))
+            }
+
+        if max_residues_per_batch:
+            self._bucket(max_residues_per_batch,
+                            shuffle=shuffle or bool(validation_split or split_path))
+        elif self.replicas:
+            self._distribute(shuffle=shuffle or bool(validation_split or split_path))
+
+        super().__init__(self.train_dataset, **self._loader_kwargs(self.train_dataset,
+                                                                    self.train_sampler))
 
-    def _split(self, validation_split: float):
+    def _load_dataset(self, path: str):
+        """ Returns the dataset of a path, shared with the workers instead of copied
+        Args:
+            path: path to the dataset
+        """
+        dataset = self.dataset_loader(path, **self.dataset_args)
+        if self.init_kwargs['num_workers']:
+            dataset.share_memory()
+        dataset.reuse_buffers = self.reuse_buffers
+
+        return dataset
+
+    def _stream(self, train_path: list, shuffle: bool, shuffle_buffer: int,
+                    validation_split: float, split_path: str = None):
+        """ Creates streaming datasets over all training datasets
+        Args:
+            train_path: paths to the training datasets
+            shuffle: shuffles the shards and proteins
+            shuffle_buffer: number of proteins shuffled together
+            validation_split: decimal for the split of the validation
+            split_path: split.npz of a previous run, reuses its seed
+        """
+        # derived from the seeded numpy generator, like the validation split of _split
+        seed = np.random.randint(2 ** 31)
+        if split_path:
+            split = np.load(split_path)
+            seed = int(split['seed'])
+            validation_split = float(split['validation_split'])
+
+        self.train_dataset = StreamingDataset(
+            self.dataset_loader, train_path, self.dataset_args, shuffle=shuffle,
+            shuffle_buffer=shuffle_buffer, seed=seed, validation_split=validation_split)
+        self.valid_dataset = StreamingDataset(
+            self.dataset_loader, train_path, self.dataset_args, shuffle=False,
+            seed=seed, validation_split=validation_split, validation=True)
+
+        self.init_kwargs.pop('shuffle')
+
+        super().__init__(self.train_dataset, **self.init_kwargs)
+
+    def set_epoch(self, epoch: int):
+        """ Sets the epoch of streaming datasets, which derive their order from it
+        Args:
+            epoch: current epoch
+        """
+        if isinstance(self.train_dataset, StreamingDataset):
+            self.train_dataset.set_epoch(epoch)
+        elif hasattr(self.train_sampler, 'set_epoch'):
+            self.train_sampler.set_epoch(epoch)
+
+    def _split(self, validation_split: float, split_path: str = None):
         """ Creates a sampler to extract training and validation data
         Args:
             validation_split: decimal for the split of the validation
+            split_path: split.npz of a previous run to reuse instead of a new split
         """
-        # random indices based off the validation split
         num_train = len(self.train_dataset)
-        train_indices = np.array(range(num_train))
-        validation_indices = np.random.choice(train_indices, int(
-            num_train * validation_split), replace=False)
 
-        train_indices = np.delete(train_indices, validation_indices)
+        if split_path:
+            log.info(f'Loading training and validation split: {split_path}')
+            split = np.load(split_path)
+            train_indices, validation_indices = split['train'], split['valid']
+
+            indices = np.concatenate([train_indices, validation_indices])
+            if indices.max(initial=0) >= num_train:
+                raise ValueError(f'Split {split_path} does not match the training data')
+        else:
+            # random indices based off the validation split
+            train_indices = np.array(range(num_train))
+            validation_indices = np.random.choice(train_indices, int(
+                num_train * validation_split), replace=False)
+
+            train_indices = np.delete(train_indices, validation_indices)
 
         # subset the dataset
         train_idx, valid_idx = train_indices, validation_indices
@@ -63,17 +224,105 @@ class DataLoaderBase(DataLoader):
         self.train_sampler = train_sampler
         self.valid_sampler = valid_sampler
 
+    def save_split(self, path: str):
+        """ Saves the training and validation split, so it can be reused with split_path
+        Args:
+            path: path of the split.npz file
+        """
+        if isinstance(self.train_dataset, StreamingDataset):
+            np.savez(path, seed=self.train_dataset.seed,
+                        validation_split=self.train_dataset.validation_split)
+        elif self.valid_sampler is not None:
+            np.savez(path, train=self.train_sampler.indices,
+                        valid=self.valid_sampler.indices)
+
+    def _bucket(self, max_residues: int, shuffle: bool):
+        """ Replaces the samplers with batch samplers of proteins of similar length
+        Args:
+            max_residues: maximum of padded residues in a batch
+            shuffle: shuffles the training batches
+        """
+        lengths = self.train_dataset.lengths
+
+        if self.train_sampler is None:
+            train_idx = np.arange(len(self.train_dataset))
+        else:
+            train_idx = self.train_sampler.indices
+        self.train_sampler = BucketBatchSampler(train_idx, lengths, max_residues,
+                                                shuffle=shuffle, **self.replicas)
+
+        # validation batches are not repeated to make the processes of a distributed
+        # run even
+        if self.valid_sampler is not None:
+            self.valid_sampler = BucketBatchSampler(
+                self.valid_sampler.indices, lengths, max_residues, shuffle=True,
+                pad=False, **self.replicas)
+
+    def _distribute(self, shuffle: bool):
+        """ Replaces the samplers with samplers of the part of the data of this process.
+        Training indices are repeated so every process trains the same number of steps.
+        Args:
+            shuffle: shuffles the training data every epoch
+        """
+        if self.train_sampler is None:
+            train_idx = np.arange(len(self.train_dataset))
+        else:
+            train_idx = self.train_sampler.indices
+        self.train_sampler = DistributedSubsetSampler(train_idx, shuffle=shuffle,
+                                                        **self.replicas)
+
+        if self.valid_sampler is not None:
+            self.valid_sampler = DistributedSubsetSampler(
+                self.valid_sampler.indices, shuffle=False, pad=False, **self.replicas)
+
+    def _loader_kwargs(self, dataset, sampler=None) -> dict:
+        """ Returns the DataLoader arguments for a dataset and its sampler
+        Args:
+            dataset: dataset of the data loader
+            sampler: sampler of the indices, batch sampler of the indices of whole
+                batches or None for the order given by shuffle
+        """
+        kwargs = dict(self.init_kwargs)
+        if sampler is not None:
+            kwargs.pop('shuffle', None)
+
+        if self.batch_fetch:
+            if not isinstance(sampler, BucketBatchSampler):
+                if sampler is None:
+                    shuffle = kwargs.get('shuffle', False)
+                    sampler = (RandomSampler(dataset) if shuffle
+                                else SequentialSampler(dataset))
+                sampler = BatchSampler(sampler, kwargs['batch_size'], drop_last=False)
+
+            # each index of the sampler is a batch, which the dataset returns collated
+            kwargs.update(batch_size=None, collate_fn=None)
+            kwargs.pop('shuffle', None)
+            return {'sampler': sampler, **kwargs}
+
+        if isinstance(sampler, BucketBatchSampler):
+            kwargs.pop('batch_size')
+            kwargs.pop('shuffle', None)
+            return {'batch_sampler': sampler, **kwargs}
+
+        return {'sampler': sampler, **kwargs}
+
     def split_validation(self) -> DataLoader:
         """ Returns the validation data """
-        if self.valid_sampler is None:
+        if isinstance(self.valid_dataset, StreamingDataset):
+            if not self.valid_dataset.validation_split:
+                return None
+            return DataLoader(self.valid_dataset, **self.init_kwargs)
+        elif self.valid_sampler is None:
             return None
         else:
-            return DataLoader(self.valid_dataset, sampler=self.valid_sampler, **self.init_kwargs)
+            kwargs = self._loader_kwargs(self.valid_dataset, self.valid_sampler)
+            return DataLoader(self.valid_dataset, **kwargs)
 
     def get_test(self) -> list:
         """ Returns the test data """
         test_data = []
         for path in self.test_path:
-            test_data.append(
-                (path, DataLoader(self.dataset_loader(path), **self.init_kwargs)))
+            dataset = self._load_dataset(path)
+            loader = DataLoader(dataset, **self._loader_kwargs(dataset))
+            test_data.append((path, loader))
         return test_data
@@ -1,33 +1,535 @@
 import torch
 import numpy as np
-import h5py
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.nn.utils.rnn import pad_sequence
+
+from challenge.utils import (
+    open_memmap,
+    read_shape,
+    iter_proteins,
+    protein_lengths,
+    is_converted,
+    read_manifest,
+    ConvertedDataset
+)
+from challenge.utils.storage import (
+    N_ENCODING,
+    N_FEATURES,
+    split_channels,
+    encode_residues,
+    decode_residues,
+    encode_labels
+)
+
+
+STORAGES = ['memory', 'mmap']
+LAYOUTS = ['padded', 'packed']
+DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16
+}
 
 
 class DatasetBase(Dataset):
     """ Base class for dataset """
 
-    def __init__(self, path: str):
+    # feature channels used by the dataset, only these are read and kept in memory
+    channels = slice(0, N_FEATURES)
+
+    def __init__(self, path: str, storage: str = 'memory', layout: str = 'padded',
+                    dtype: str = 'float32', compact: bool = False):
         """ Constructor
+        Args:
+            path: file path for the dataset, or the directory of a dataset written by
+                ``challenge convert``
+            storage: 'memory' loads the whole dataset, 'mmap' memory-maps an
+                uncompressed copy of it and only reads the proteins that are requested
+            layout: 'padded' keeps every protein padded to the longest one, 'packed'
+                stores only the residues of each protein back to back. Converted
+                datasets are packed
+            dtype: precision the input features are stored in, 'float32', 'float16' or
+                'bfloat16'. Batches are converted back to float32 by pad_collate.
+                Converted datasets keep the precision they were converted with
+            compact: stores the labels as int8 (mask, Q8 class, Q3 class) instead of the
+                float channels of the dataset files and the amino acids as uint8 indices
+                that are expanded to one-hot when read. The other label channels are
+                dropped
+        """
+        if storage not in STORAGES:
+            raise ValueError(f'Unknown storage "{storage}", expected one of {STORAGES}')
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown layout "{layout}", expected one of {LAYOUTS}')
+        if dtype not in DTYPES:
+            raise ValueError(f'Unknown dtype "{dtype}", expected one of {list(DTYPES)}')
+
+        self.path = path
+        self.storage = storage
+        self.layout = layout
+        self.dtype = DTYPES[dtype]
+        self.compact = compact
+        self.n_features = len(range(N_FEATURES)[self.channels])
+
+        # start of each protein in the packed rows, and the total number of rows
+        self.offsets = None
+        self._lengths = None
+        self.converted = None
+        self.residues = None
+
+        # if set, batches fetched with gather are written into the same tensors
+        self.reuse_buffers = False
+        self._buffers = {}
+
+        if is_converted(path):
+            self.converted = ConvertedDataset(path, self.channels,
+                                                mmap=storage == 'mmap', compact=compact)
+            self.layout = 'packed'
+            self._lengths = self.converted.lengths
+        elif storage == 'mmap':
+            if layout == 'packed':
+                raise ValueError('The packed layout is only supported with memory '
+                                    'storage')
+            if dtype != 'float32':
+                raise ValueError('Reduced precision is only supported with memory '
+                                    'storage')
+            if compact:
+                raise ValueError('Compact labels are only supported with memory '
+                                    'storage')
+
+            self._open_memmap(path)
+        elif layout == 'packed':
+            self._load_packed(path)
+        else:
+            self._load(path)
+
+    def _open_memmap(self, path: str):
+        """ Memory-maps the configured channels
         Args:
             path: file path for the dataset
         """
-        data = torch.from_numpy(np.load(path)['data'])
+        data = open_memmap(path)
+
+        self.X = data[:, :, self.channels]
+        self.y = data[:, :, N_FEATURES:]
+
+    def _load(self, path: str):
+        """ Loads the configured channels into memory, reading the file in chunks of
+        proteins so the full array of all channels is never held at once
+        Args:
+            path: file path for the dataset
+        """
+        shape, _ = read_shape(path)
+
+        if self.compact:
+            encoding, embedding = split_channels(self.channels)
+            if encoding.stop > encoding.start:
+                self.residues = torch.empty(shape[:2], dtype=torch.uint8)
+            self.X = None
+            if embedding.stop > embedding.start:
+                n_embedding = embedding.stop - embedding.start
+                self.X = torch.empty((*shape[:2], n_embedding), dtype=self.dtype)
+            self.y = torch.empty((*shape[:2], 3), dtype=torch.int8)
+        else:
+            self.X = torch.empty((*shape[:2], self.n_features), dtype=self.dtype)
+            self.y = torch.empty((*shape[:2], shape[2] - N_FEATURES),
+                                    dtype=torch.float32)
+
+        for start, chunk in iter_proteins(path):
+            end = start + len(chunk)
+            tensors = (self.residues, self.X, self.y)
+            for tensor, values in zip(tensors, self._encode(chunk)):
+                if tensor is not None:
+                    tensor[start:end] = values
+
+    def _load_packed(self, path: str):
+        """ Loads the residues of each protein without padding into (residues, channels)
+        tensors
+        Args:
+            path: file path for the dataset
+        """
+        residues, X, y, lengths = [], [], [], []
+
+        for _, chunk in iter_proteins(path):
+            chunk_lengths = protein_lengths(chunk[:, :, N_FEATURES])
+            rows = np.arange(chunk.shape[1]) < chunk_lengths[:, None]
 
-        self.X = data[:, :, :1300].clone().detach().float()
-        self.y = data[:, :, 1300:].clone().detach().float()
+            for tensors, values in zip((residues, X, y), self._encode(chunk[rows])):
+                tensors.append(values)
+            lengths.append(chunk_lengths)
 
-        del data
+        self.residues = torch.cat(residues) if residues[0] is not None else None
+        self.X = torch.cat(X) if X[0] is not None else None
+        self.y = torch.cat(y)
+        self._lengths = np.concatenate(lengths)
+        self.offsets = np.concatenate([[0], np.cumsum(self._lengths)])
+
+    def _encode(self, data: np.ndarray) -> (torch.tensor, torch.tensor, torch.tensor):
+        """ Returns the amino acids, input features and labels of (..., channels) data
+        as they are kept in memory. The amino acids are None unless compact, where the
+        input features are only the embedding channels.
+        Args:
+            data: proteins or residues with all channels of the dataset files
+        """
+        if not self.compact:
+            X = torch.from_numpy(np.array(data[..., self.channels], dtype=np.float32))
+            y = torch.from_numpy(np.array(data[..., N_FEATURES:], dtype=np.float32))
+            return None, X.to(self.dtype), y
+
+        encoding, embedding = split_channels(self.channels)
+        residues, X = None, None
+        if encoding.stop > encoding.start:
+            residues = torch.from_numpy(encode_residues(data[..., :N_ENCODING]))
+        if embedding.stop > embedding.start:
+            X = data[..., N_ENCODING:N_FEATURES][..., embedding]
+            X = torch.from_numpy(np.array(X, dtype=np.float32)).to(self.dtype)
+
+        return residues, X, torch.from_numpy(encode_labels(data[..., N_FEATURES:]))
+
+    def _features(self, index) -> torch.tensor:
+        """ Returns the input features of an index of the stored tensors, expanding the
+        amino acids of compact datasets to one-hot
+        Args:
+            index: index, slice or rows of the stored tensors
+        """
+        if not self.compact:
+            return self._to_tensor(self.X[index])
+
+        features = []
+        if self.residues is not None:
+            encoding, _ = split_channels(self.channels)
+            residues = decode_residues(self.residues[index], encoding)
+            features.append(residues.to(self.dtype))
+        if self.X is not None:
+            features.append(self.X[index])
+
+        return features[0] if len(features) == 1 else torch.cat(features, dim=-1)
+
+    def share_memory(self):
+        """ Moves the tensors of in-memory datasets to shared memory, so data loader
+        workers use them without a copy. Memory maps are reopened by each worker.
+        """
+        tensors = (self.residues, getattr(self, 'X', None), getattr(self, 'y', None))
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                tensor.share_memory_()
+
+    def __getstate__(self) -> dict:
+        """ Returns the state sent to the workers, without the memory-mapped arrays """
+        state = self.__dict__.copy()
+        if self.storage == 'mmap' and self.converted is None:
+            state['X'], state['y'] = None, None
+
+        return state
+
+    def __setstate__(self, state: dict):
+        """ Restores the state in a worker and reopens the memory-mapped arrays """
+        self.__dict__.update(state)
+        if self.storage == 'mmap' and self.converted is None:
+            self._open_memmap(self.path)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """ Returns the number of residues of each protein """
+        if self._lengths is None:
+            self._lengths = protein_lengths(np.asarray(self.y[:, :, 0]))
+
+        return self._lengths
 
     def __getitem__(self, index: int) -> (torch.tensor, torch.tensor, torch.tensor):
         """ Returns input, label and mask
         Args:
-            index: Index of the array
+            index: Index of the array, or a list of indices of a padded batch, see
+                gather
         """
+        if isinstance(index, (list, np.ndarray, torch.Tensor)):
+            return self.gather(index)
+
+        if self.converted is not None:
+            X, y = self.converted[index]
+        elif self.offsets is not None:
+            rows = slice(int(self.offsets[index]), int(self.offsets[index + 1]))
+            X, y = self._features(rows), self.y[rows]
+        else:
+            X, y = self._features(index), self._to_tensor(self.y[index])
+
+        return X, y, y[:, 0]
+
+    def gather(self, indices: list) -> (torch.tensor, torch.tensor, torch.tensor):
+        """ Returns the input, label and mask of several proteins as a padded batch,
+        read with one vectorized gather instead of one __getitem__ and pad_collate per
+        protein. The batch is padded like pad_collate: to the longest protein of the
+        batch for packed datasets, to the length of the dataset for padded ones.
+        Args:
+            indices: indices of the proteins
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if self.converted is not None:
+            n_residues = int(self.lengths[indices].max(initial=0))
+            X = self._output('X', (len(indices), n_residues, self.n_features))
+            y = self._output('y', (len(indices), n_residues, self.converted.n_labels),
+                                torch.int8 if self.compact else torch.float32)
+            self.converted.gather(indices, X, y)
+        elif self.offsets is not None:
+            lengths = torch.from_numpy(self.lengths[indices])
+            positions = torch.arange(int(lengths.max()) if len(indices) else 0)
+            valid = positions < lengths[:, None]
+            rows = (torch.from_numpy(self.offsets[indices])[:, None] + positions)[valid]
 
-        return self.X[index], self.y[index], self.y[index][0]
+            X = self._output('X', (*valid.shape, self.n_features))
+            y = self._output('y', (*valid.shape, self.y.shape[-1]), self.y.dtype)
+            X[valid] = self._features(rows).float()
+            y[valid] = self.y[rows]
+        elif self.storage == 'mmap':
+            X = self._output('X', (len(indices), *self.X.shape[1:]))
+            y = self._output('y', (len(indices), *self.y.shape[1:]))
+            X.numpy()[:] = self.X[indices]
+            y.numpy()[:] = self.y[indices]
+        else:
+            indices = torch.from_numpy(indices)
+            X = self._output('X', (len(indices), *self.y.shape[1:2], self.n_features))
+            y = self._output('y', (len(indices), *self.y.shape[1:]), self.y.dtype)
+            X.copy_(self._features(indices))
+            torch.index_select(self.y, 0, indices, out=y)
+
+        return X, y, y[:, :, 0]
+
+    def _output(self, name: str, shape: tuple,
+                    dtype: torch.dtype = torch.float32) -> torch.tensor:
+        """ Returns a zeroed tensor for a batch, a view of a preallocated buffer that is
+        only grown for larger batches if reuse_buffers is set
+        Args:
+            name: name of the buffer
+            shape: shape of the tensor
+            dtype: type of the tensor
+        """
+        if not self.reuse_buffers:
+            return torch.zeros(shape, dtype=dtype)
+
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or len(buffer) < size:
+            buffer = self._buffers[name] = torch.empty(size, dtype=dtype)
+
+        return buffer[:size].view(shape).zero_()
 
     def __len__(self):
         """ Returns the length of the data """
+        if self.converted is not None:
+            return len(self.converted)
+        elif self.offsets is not None:
+            return len(self.offsets) - 1
+
+        # the labels are loaded by every dataset loader, the inputs are not
+        return len(self.y)
+
+    @staticmethod
+    def _to_tensor(array) -> torch.tensor:
+        """ Returns a float tensor, copying arrays read from a memory map
+        Args:
+            array: tensor or memory-mapped array
+        """
+        if isinstance(array, np.ndarray):
+            return torch.from_numpy(np.array(array, dtype=np.float32))
+
+        return array
+
+
+class StreamingDataset(IterableDataset):
+    """ Streams the proteins of several datasets (shards) from disk, a shard at a time.
+    The shards of converted datasets are memory-mapped and only the current one is open
+    """
+
+    def __init__(self, dataset_loader: type, paths: list, dataset_args: dict = None,
+                    shuffle: bool = True, shuffle_buffer: int = 1000, seed: int = 0,
+                    validation_split: float = 0, validation: bool = False):
+        """ Constructor
+        Args:
+            dataset_loader: dataset class used to read each shard
+            paths: file paths of the datasets, the shards of converted datasets are
+                streamed separately
+            dataset_args: keyword arguments for the dataset class, converted datasets
+                are memory-mapped whatever their storage
+            shuffle: shuffles the order of the shards and the proteins every epoch
+            shuffle_buffer: number of proteins each next protein is drawn from at random
+            seed: seed of the shuffling and of the validation split
+            validation_split: decimal of the proteins of every shard held out for
+                validation
+            validation: streams the held out proteins instead of the remaining ones
+        """
+        self.dataset_loader = dataset_loader
+        self.dataset_args = dataset_args or {}
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.seed = seed
+        self.validation_split = validation_split
+        self.validation = validation
+
+        # in shared memory, so persistent data loader workers see the epoch of set_epoch
+        self.epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+
+        # each shard is the path of a dataset and the range of its proteins
+        self.shards = []
+        for path in paths:
+            if is_converted(path):
+                start = 0
+                for shard in read_manifest(path)['shards']:
+                    self.shards.append((path, start, start + shard['proteins']))
+                    start += shard['proteins']
+            else:
+                shape, _ = read_shape(path)
+                self.shards.append((path, 0, shape[0]))
+
+    def set_epoch(self, epoch: int):
+        """ Sets the epoch the order of the next iterations is derived from """
+        self.epoch.fill_(epoch)
+
+    def _open(self, path: str):
+        """ Opens a dataset, memory-mapping the shards of converted datasets """
+        if is_converted(path):
+            return self.dataset_loader(path, **{**self.dataset_args, 'storage': 'mmap'})
+
+        return self.dataset_loader(path, **self.dataset_args)
+
+    def _selected(self, shard_idx: int) -> np.ndarray:
+        """ Returns the proteins of a shard in this split, the same for every epoch """
+        path, start, stop = self.shards[shard_idx]
+        held_out = np.random.RandomState([self.seed, shard_idx]).rand(stop - start)
+        held_out = held_out < self.validation_split
+
+        return np.arange(start, stop)[held_out == self.validation]
+
+    def _assigned(self, order: np.ndarray) -> list:
+        """ Returns the (shard, step, offset) of the proteins this worker reads """
+        worker = get_worker_info()
+        if worker is None:
+            return [(shard_idx, 1, 0) for shard_idx in order]
+
+        # whole shards are split across the workers, unless there are fewer shards than
+        # workers
+        if len(order) >= worker.num_workers:
+            shards = order[worker.id::worker.num_workers]
+            return [(shard_idx, 1, 0) for shard_idx in shards]
+
+        return [(shard_idx, worker.num_workers, worker.id) for shard_idx in order]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+
+        # the shard order is the same in all workers, the protein order differs
+        epoch = int(self.epoch)
+        order_rng = np.random.RandomState([self.seed, epoch])
+        rng = np.random.RandomState([self.seed, epoch, worker_id])
+
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = order_rng.permutation(order)
+
+        buffer = []
+        dataset, dataset_path = None, None
+        for shard_idx, step, offset in self._assigned(order):
+            path = self.shards[shard_idx][0]
+            if path != dataset_path:
+                # the previous shard is released before the next one is loaded
+                dataset = None
+                dataset, dataset_path = self._open(path), path
+            if dataset.converted is not None:
+                dataset.converted.release()
+
+            proteins = self._selected(shard_idx)[offset::step]
+            if self.shuffle:
+                proteins = rng.permutation(proteins)
+
+            for index in proteins:
+                item = dataset[index]
+                if not self.shuffle_buffer:
+                    yield item
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                else:
+                    # yield a random protein of the buffer, the new one takes its place
+                    position = rng.randint(len(buffer))
+                    yield buffer[position]
+                    buffer[position] = item
+
+            # streaming reads one shard at a time
+            assert dataset.converted is None or len(dataset.converted.open_shards) <= 1
+
+        for position in rng.permutation(len(buffer)):
+            yield buffer[position]
+
+    def __len__(self):
+        """ Returns the number of proteins of the split over all shards """
+        return sum(len(self._selected(shard_idx))
+                    for shard_idx in range(len(self.shards)))
+
+
+def stream_batches(path: str, dataset_loader: type, dataset_args: dict = None,
+                    batch_size: int = 1, max_residues: int = None) -> (torch.tensor,
+                                                                        torch.tensor):
+    """ Reads the proteins of a dataset in order and in chunks, so only a chunk of the
+    file and the current batch are in memory, eg. to predict files larger than memory
+    Args:
+        path: file path for the dataset, or the directory of a converted dataset
+        dataset_loader: dataset class, whose channels are the input features
+        dataset_args: keyword arguments for the dataset class, used for converted
+            datasets
+        batch_size: largest number of proteins of a batch
+        max_residues: if set, largest number of padded residues of a batch (proteins
+            times the longest protein)
+    Returns:
+        padded float32 input features and mask of each batch
+    """
+    def proteins():
+        """ Yields the features and mask of each protein, without padding """
+        if is_converted(path):
+            # the shards of converted datasets are memory-mapped and read one at a time
+            streaming = StreamingDataset(dataset_loader, [path], dataset_args,
+                                            shuffle=False)
+            for X, _, mask in streaming:
+                yield X, mask
+            return
+
+        for _, chunk in iter_proteins(path):
+            mask = chunk[:, :, N_FEATURES]
+            for protein, length in zip(chunk, protein_lengths(mask)):
+                features = protein[:length, dataset_loader.channels]
+                yield (torch.from_numpy(np.array(features)),
+                        torch.from_numpy(np.array(protein[:length, N_FEATURES])))
+
+    def padded(X: list, mask: list) -> (torch.tensor, torch.tensor):
+        """ Returns the batch of the proteins padded to the longest one """
+        return (pad_sequence([x.float() for x in X], batch_first=True),
+                pad_sequence(mask, batch_first=True))
+
+    X, mask, longest = [], [], 0
+    for features, protein_mask in proteins():
+        # the batch is complete if the protein does not fit into it anymore
+        full = len(X) == batch_size or (
+            max_residues and (len(X) + 1) * max(longest, len(features)) > max_residues)
+        if X and full:
+            yield padded(X, mask)
+            X, mask, longest = [], [], 0
+
+        X.append(features)
+        mask.append(protein_mask)
+        longest = max(longest, len(features))
+
+    if X:
+        yield padded(X, mask)
+
+
+def pad_collate(batch: list) -> (torch.tensor, torch.tensor, torch.tensor):
+    """ Collates proteins of different lengths, padding them to the longest protein of
+    the batch. Inputs stored in reduced precision are converted to float32.
+    Args:
+        batch: list of (input, label, mask) of each protein
+    """
+    X, y, mask = zip(*batch)
 
-        return len(self.X)
\ No newline at end of file
+    return (
+        pad_sequence(X, batch_first=True).float(),
+        pad_sequence(y, batch_first=True),
+        pad_sequence(mask, batch_first=True)
+    )
@@ -1,3 +1,6 @@
+from typing import List
+
+import torch
 import torch.nn as nn
 import numpy as np
 
@@ -13,9 +16,43 @@ class ModelBase(nn.Module):
 
         raise NotImplementedError
 
+    def export(self) -> nn.Module:
+        """ Returns the module written by ``challenge export``. It is called with the
+        trained weights loaded and has to return the same outputs as forward, models can
+        replace layers with faster equivalents for inference
+        """
+        return self
+
     def __str__(self):
         """ Model prints with number of trainable parameters """
         
         model_parameters = filter(lambda p: p.requires_grad, self.parameters())
         params = sum([np.prod(p.size()) for p in model_parameters])
         return super().__str__() + f"\nTrainable parameters: {params}"
+
+
+class MergedLinear(nn.Module):
+    """ Linear output heads over the same input merged into one projection, which
+    computes all heads with a single matrix multiplication instead of one per head
+    """
+
+    def __init__(self, heads: List[nn.Linear]):
+        """ Constructor
+        Args:
+            heads: linear layers of the same input, their outputs are returned in this
+                order
+        """
+        super().__init__()
+
+        self.sizes = [head.out_features for head in heads]
+        self.projection = nn.Linear(heads[0].in_features, sum(self.sizes),
+                                    bias=heads[0].bias is not None)
+        with torch.no_grad():
+            self.projection.weight.copy_(torch.cat([head.weight for head in heads]))
+            if self.projection.bias is not None:
+                self.projection.bias.copy_(torch.cat([head.bias for head in heads]))
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> List[torch.Tensor]:
+        """ Forwarding logic, returns the output of each head """
+
+        return list(torch.split(self.projection(x), self.sizes, dim=-1))
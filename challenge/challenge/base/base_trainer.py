@@ -5,11 +5,15 @@ import yaml
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 
 from challenge.utils import (
     setup_logger,
     trainer_paths,
-    TensorboardWriter
+    TensorboardWriter,
+    CheckpointWriter,
+    is_main_process,
+    broadcast_object
 )
 
 
@@ -43,19 +47,35 @@ class TrainerBase:
 
         self._setup_monitoring(config['training'])
 
-        self.checkpoint_dir, self.writer_dir = trainer_paths(config)
+        # only the main process of a distributed run writes checkpoints, tensorboard and
+        # the configuration, the other processes use its paths
+        self.main_process = is_main_process()
+        paths = trainer_paths(config) if self.main_process else None
+        self.checkpoint_dir, self.writer_dir = broadcast_object(paths)
         self.writer = TensorboardWriter(
-            self.writer_dir, config['training']['tensorboard'])
+            self.writer_dir, config['training']['tensorboard'] and self.main_process)
+        self.checkpoint_writer = CheckpointWriter(
+            self.checkpoint_dir, config['training'].get('keep_last_k'))
 
         # Save configuration file into checkpoint directory:
-        config_save_path = Path(self.checkpoint_dir) / 'config.yml'
-        with open(config_save_path, 'w') as handle:
-            yaml.dump(config, handle, default_flow_style=False)
+        if self.main_process:
+            config_save_path = Path(self.checkpoint_dir) / 'config.yml'
+            with open(config_save_path, 'w') as handle:
+                yaml.dump(config, handle, default_flow_style=False)
 
     def train(self):
         """ Full training logic """
 
         log.info('Starting training...')
+        try:
+            self._train()
+        finally:
+            # checkpoints are written in the background, the best model is loaded after
+            # training
+            self.checkpoint_writer.close()
+
+    def _train(self):
+        """ Trains the epochs, saving checkpoints and stopping early """
         for epoch in range(self.start_epoch, self.epochs):
             result = self._train_epoch(epoch)
 
@@ -106,7 +126,7 @@ class TrainerBase:
                                      "epochs. Training stops.")
                     break
 
-            if epoch % self.save_period == 0:
+            if epoch % self.save_period == 0 and self.main_process:
                 self._save_checkpoint(epoch, save_best=best)
 
     def _train_epoch(self, epoch: int) -> dict:
@@ -115,28 +135,27 @@ class TrainerBase:
         raise NotImplementedError
 
     def _save_checkpoint(self, epoch: int, save_best: bool = False):
-        """ Saving checkpoints
+        """ Saving checkpoints, written in the background by the checkpoint writer
         Args:
             epoch: current epoch number
-            save_best: if True, rename the saved checkpoint to 'model_best.pth'
+            save_best: if True, also save the checkpoint as 'model_best.pth'
         """
 
-        arch = type(self.model).__name__
+        # distributed models are saved without their wrapper, like single process ones
+        model = self.model
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+
+        arch = type(model).__name__
         state = {
             'arch': arch,
             'epoch': epoch,
-            'state_dict': self.model.state_dict(),
+            'state_dict': model.state_dict(),
             'optimizer': self.optimizer.state_dict(),
             'monitor_best': self.mnt_best,
             'config': self.config
         }
-        filename = self.checkpoint_dir / f'checkpoint-epoch{epoch}.pth'
-        torch.save(state, filename)
-        log.info(f"Saving checkpoint: {filename} ...")
-        if save_best:
-            best_path = self.checkpoint_dir / 'model_best.pth'
-            torch.save(state, best_path)
-            log.info(f'Saving current best: {best_path}')
+        self.checkpoint_writer.save(state, epoch, save_best)
 
     def _setup_monitoring(self, config: dict) -> None:
         """ Configuration to monitor model performance and save best. 
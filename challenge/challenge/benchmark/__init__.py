@@ -0,0 +1,2 @@
+from .synthetic import make_dataset, protein_lengths, LENGTH_DISTRIBUTIONS
+from .suite import run_benchmarks, compare, BENCHMARKS
@@ -0,0 +1,491 @@
+import io
+import os
+import gc
+import sys
+import copy
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import contextlib
+from pathlib import Path
+
+import yaml
+import numpy as np
+import torch
+
+import challenge.data_loader.data_loaders as module_data
+import challenge.data_loader.dataset_loaders as module_dataset
+import challenge.models.metric as module_metric
+import challenge.models as module_arch
+import torch.optim as module_optimizer
+
+from challenge import main
+from challenge.models.metric import MetricTracker, get_mask
+from challenge.utils import setup_logger, autocast, grad_scaler
+
+from .synthetic import make_dataset
+
+
+log = setup_logger(__name__)
+
+BENCHMARKS = ['load', 'loader', 'train_step', 'eval_step', 'time_to_accuracy',
+                'predict', 'cold_start']
+
+# modules only needed for training, which the prediction entrypoint should not import
+TRAINING_MODULES = ['challenge.trainer', 'challenge.benchmark', 'torchvision',
+                    'torch.utils.tensorboard', 'h5py', 'pandas']
+
+
+def run_benchmarks(cfg: dict, output: str, baseline: str = None, n_proteins: int = 256,
+                    max_length: int = 400, distribution: str = 'lognormal',
+                    steps: int = 20, target_accuracy: float = 0.9, max_epochs: int = 20,
+                    benchmarks: list = None, data_dir: str = None) -> dict:
+    """ Runs the benchmarks on synthetic datasets with the settings of a configuration
+    and writes the results as JSON
+    Args:
+        cfg: configuration of the model, data loader, loss and training
+        output: path of the JSON results
+        baseline: JSON results of a previous run to compare with
+        n_proteins: number of proteins of the synthetic training dataset, the test
+            dataset has a quarter of them
+        max_length: longest protein of the synthetic datasets
+        distribution: distribution of the protein lengths, 'lognormal', 'uniform' or
+            'fixed'
+        steps: number of timed training and evaluation steps
+        target_accuracy: Q8 accuracy on the validation data of time_to_accuracy
+        max_epochs: epochs after which time_to_accuracy stops without reaching the
+            target
+        benchmarks: names of the benchmarks to run, all of BENCHMARKS if None
+        data_dir: directory of the synthetic datasets, which are kept. A temporary
+            directory is used and removed if None
+    Returns:
+        the results
+    """
+    benchmarks = benchmarks or BENCHMARKS
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f'Unknown benchmarks {sorted(unknown)}, '
+                            f'expected some of {BENCHMARKS}')
+
+    with contextlib.ExitStack() as stack:
+        if data_dir is None:
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        data_dir = Path(data_dir)
+        data_dir.mkdir(parents=True, exist_ok=True)
+
+        # the datasets are named after their settings, so a kept dataset is only
+        # reused by runs with the same settings
+        n_test = max(n_proteins // 4, 1)
+        train_path = data_dir / f'train_{n_proteins}_{max_length}_{distribution}.npz'
+        test_path = data_dir / f'test_{n_test}_{max_length}_{distribution}.npz'
+        if not train_path.exists():
+            make_dataset(train_path, n_proteins, max_length, distribution, seed=0)
+        if not test_path.exists():
+            make_dataset(test_path, n_test, max_length, distribution, seed=1)
+
+        cfg = synthetic_config(cfg, train_path, test_path, data_dir)
+        main.seed_everything(cfg['seed'])
+
+        results = {}
+        for name in BENCHMARKS:
+            if name not in benchmarks:
+                continue
+
+            log.info(f'Benchmark {name}')
+            if name == 'load':
+                results[name] = benchmark_load(cfg, train_path)
+            elif name == 'loader':
+                results[name] = benchmark_loader(cfg)
+            elif name == 'train_step':
+                results[name] = benchmark_train_step(cfg, steps)
+            elif name == 'eval_step':
+                results[name] = benchmark_eval_step(cfg, steps)
+            elif name == 'time_to_accuracy':
+                results[name] = benchmark_time_to_accuracy(
+                    cfg, target_accuracy, max_epochs, data_dir / 'model.pth')
+            elif name == 'predict':
+                results[name] = benchmark_predict(cfg, data_dir / 'model.pth',
+                                                    test_path)
+            elif name == 'cold_start':
+                results[name] = benchmark_cold_start(cfg, data_dir / 'model.pth',
+                                                        test_path)
+
+    report = {
+        'settings': {
+            'proteins': n_proteins,
+            'max_length': max_length,
+            'distribution': distribution,
+            'steps': steps,
+            'target_accuracy': target_accuracy,
+            'max_epochs': max_epochs
+        },
+        'environment': environment(),
+        'results': results
+    }
+
+    if baseline:
+        with open(baseline) as handle:
+            report['comparison'] = compare(results, json.load(handle)['results'])
+
+    with open(output, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    log.info(f'Benchmark results written to {output}')
+
+    return report
+
+
+def synthetic_config(cfg: dict, train_path: Path, test_path: Path,
+                        save_dir: Path) -> dict:
+    """ Returns a copy of the configuration that reads the synthetic datasets
+    Args:
+        cfg: configuration of the model, data loader, loss and training
+        train_path: path of the synthetic training dataset
+        test_path: path of the synthetic test dataset
+        save_dir: directory for the files written by the benchmarks
+    """
+    cfg = copy.deepcopy(cfg)
+    cfg['save_dir'] = str(save_dir)
+
+    args = cfg['data_loader']['args']
+    args['train_path'] = [str(train_path)]
+    args['test_path'] = [str(test_path)]
+    args['split_path'] = None
+    args['streaming'] = False
+    args['validation_split'] = args.get('validation_split') or 0.1
+
+    return cfg
+
+
+def environment() -> dict:
+    """ Returns the versions and hardware the benchmarks ran with """
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+    }
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """ Logs and returns the ratio of each result to the baseline
+    Args:
+        results: results of this run
+        baseline: results of the baseline run
+    """
+    comparison = {}
+    log.info(f'{"benchmark":40s} {"baseline":>12s} {"current":>12s} {"ratio":>8s}')
+    for name, values in results.items():
+        for key, value in values.items():
+            base = baseline.get(name, {}).get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not isinstance(base, (int, float)) or not base:
+                continue
+
+            comparison[f'{name}.{key}'] = value / base
+            log.info(f'{name + "." + key:40s} {base:12.4f} {value:12.4f} '
+                        f'{value / base:7.2f}x')
+
+    return comparison
+
+
+def rss_mb() -> float:
+    """ Returns the resident memory of the process in MB """
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        # peak instead of the current memory where /proc is not available
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _synchronize(device: torch.device):
+    """ Waits for the queued work of the device """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _setup(cfg: dict) -> tuple:
+    """ Returns the model on its device, the device, the loss and the metrics of the
+    configuration
+    """
+    model = main.get_instance(module_arch, 'arch', cfg)
+    model, device = main.setup_device(model, cfg['target_devices'])
+    loss = main.get_loss(cfg['loss'])
+    metrics = [getattr(module_metric, met) for met in cfg['metrics']]
+    metrics_task = list(cfg['metrics'].values())
+
+    return model, device, loss, metrics, metrics_task
+
+
+def _batches(data_loader, steps: int) -> list:
+    """ Returns the first batches of the data loader, repeated up to steps batches, so
+    the steps are timed without loading the data
+    """
+    batches = []
+    while len(batches) < steps:
+        for data, target, mask in data_loader:
+            batches.append((data.clone(), target.clone(), mask.clone()))
+            if len(batches) == steps:
+                break
+
+    return batches
+
+
+def benchmark_load(cfg: dict, path: Path) -> dict:
+    """ Time and memory to load the training dataset with the dataset arguments of the
+    configuration
+    """
+    args = cfg['data_loader']['args']
+    dataset_loader = getattr(module_dataset, args['dataset_loader'])
+    dataset_args = args.get('dataset_args') or {}
+
+    gc.collect()
+    rss = rss_mb()
+    start = time.perf_counter()
+    dataset = dataset_loader(str(path), **dataset_args)
+    seconds = time.perf_counter() - start
+
+    results = {'seconds': seconds, 'rss_mb': rss_mb() - rss, 'proteins': len(dataset)}
+    del dataset
+    gc.collect()
+
+    return results
+
+
+def benchmark_loader(cfg: dict) -> dict:
+    """ Batches per second of an epoch of the training data loader """
+    data_loader = main.get_instance(module_data, 'data_loader', cfg)
+
+    batches, proteins = 0, 0
+    start = time.perf_counter()
+    for data, _, _ in data_loader:
+        batches += 1
+        proteins += data.size(0)
+    seconds = time.perf_counter() - start
+
+    return {
+        'seconds': seconds,
+        'batches_per_second': batches / seconds,
+        'proteins_per_second': proteins / seconds
+    }
+
+
+def _throughput(steps: list, seconds: float) -> dict:
+    """ Returns the throughput of timed steps of (proteins, residues) """
+    proteins = sum(step[0] for step in steps)
+    residues = sum(step[1] for step in steps)
+
+    return {
+        'steps_per_second': len(steps) / seconds,
+        'proteins_per_second': proteins / seconds,
+        'residues_per_second': residues / seconds
+    }
+
+
+def benchmark_train_step(cfg: dict, steps: int) -> dict:
+    """ Throughput of the training steps, forward, loss, backward and optimizer step, on
+    preloaded batches
+    """
+    model, device, loss_fn, _, _ = _setup(cfg)
+    param_groups = main.setup_param_groups(model, cfg['optimizer'])
+    optimizer = main.get_instance(module_optimizer, 'optimizer', cfg, param_groups)
+    precision = cfg['training'].get('precision', 'float32')
+    scaler = grad_scaler(precision)
+
+    batches = _batches(main.get_instance(module_data, 'data_loader', cfg), steps + 1)
+    model.train()
+
+    timed = []
+    for i, (data, target, mask) in enumerate(batches):
+        # the first step is a warmup and not timed
+        if i == 1:
+            _synchronize(device)
+            start = time.perf_counter()
+
+        data, target = data.to(device), target.to(device)
+        optimizer.zero_grad()
+        with autocast(precision, device):
+            output = model(data, mask)
+            loss = loss_fn(output, target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+        if i:
+            timed.append((data.size(0), int((get_mask(target) == 1).sum())))
+    _synchronize(device)
+
+    return _throughput(timed, time.perf_counter() - start)
+
+
+def benchmark_eval_step(cfg: dict, steps: int) -> dict:
+    """ Throughput of the evaluation steps, forward and metrics, on loaded batches """
+    model, device, _, metrics, metrics_task = _setup(cfg)
+    precision = cfg['training'].get('precision', 'float32')
+
+    batches = _batches(main.get_instance(module_data, 'data_loader', cfg), steps + 1)
+    model.eval()
+
+    tracker = MetricTracker(metrics, metrics_task)
+    timed = []
+    with torch.no_grad():
+        for i, (data, target, mask) in enumerate(batches):
+            if i == 1:
+                _synchronize(device)
+                start = time.perf_counter()
+
+            data, target = data.to(device), target.to(device)
+            with autocast(precision, device):
+                output = model(data, mask)
+            tracker.update(output, target)
+
+            if i:
+                timed.append((data.size(0), int((get_mask(target) == 1).sum())))
+        tracker.result()
+    _synchronize(device)
+
+    return _throughput(timed, time.perf_counter() - start)
+
+
+def benchmark_time_to_accuracy(cfg: dict, target_accuracy: float, max_epochs: int,
+                                model_path: Path) -> dict:
+    """ Time and epochs of training until the Q8 accuracy of the validation data reaches
+    the target. The trained model is saved for the predict benchmark
+    """
+    model, device, loss_fn, _, _ = _setup(cfg)
+    param_groups = main.setup_param_groups(model, cfg['optimizer'])
+    optimizer = main.get_instance(module_optimizer, 'optimizer', cfg, param_groups)
+    precision = cfg['training'].get('precision', 'float32')
+    scaler = grad_scaler(precision)
+
+    data_loader = main.get_instance(module_data, 'data_loader', cfg)
+    valid_data_loader = data_loader.split_validation()
+    q8_task = cfg['metrics'].get('metric_q8', 0)
+
+    accuracy, curve = 0., []
+    start = time.perf_counter()
+    for epoch in range(max_epochs):
+        data_loader.set_epoch(epoch)
+        model.train()
+        for data, target, mask in data_loader:
+            data, target = data.to(device), target.to(device)
+            optimizer.zero_grad()
+            with autocast(precision, device):
+                loss = loss_fn(model(data, mask), target)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+        model.eval()
+        tracker = MetricTracker([module_metric.metric_q8], [q8_task])
+        with torch.no_grad():
+            for data, target, mask in valid_data_loader:
+                data, target = data.to(device), target.to(device)
+                with autocast(precision, device):
+                    tracker.update(model(data, mask), target)
+        accuracy = tracker.result()[0]
+        curve.append({'epoch': epoch + 1, 'seconds': time.perf_counter() - start,
+                        'metric_q8': accuracy})
+
+        if accuracy >= target_accuracy:
+            break
+
+    torch.save({'arch': type(model).__name__, 'state_dict': model.state_dict(),
+                'config': cfg}, model_path)
+
+    return {
+        'reached': accuracy >= target_accuracy,
+        'seconds': curve[-1]['seconds'],
+        'epochs': len(curve),
+        'metric_q8': accuracy,
+        'curve': curve
+    }
+
+
+def benchmark_predict(cfg: dict, model_path: Path, data_path: Path,
+                        repeats: int = 3) -> dict:
+    """ End to end latency of main.predict on the test dataset, including loading the
+    model and the data and writing predictions.csv
+    """
+    if not model_path.exists():
+        model = main.get_instance(module_arch, 'arch', cfg)
+        torch.save({'arch': type(model).__name__, 'state_dict': model.state_dict()},
+                    model_path)
+
+    latencies = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    main.predict(cfg, str(model_path), str(data_path))
+                latencies.append(time.perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+
+    return {
+        'seconds': float(np.median(latencies)),
+        'min_seconds': min(latencies),
+        'max_seconds': max(latencies)
+    }
+
+
+def _run_python(args: list, cwd: str = None) -> tuple:
+    """ Runs a new python interpreter, returns its seconds and its stdout """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *args], cwd=cwd, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True)
+
+    return time.perf_counter() - start, process.stdout
+
+
+def benchmark_cold_start(cfg: dict, model_path: Path, data_path: Path,
+                            repeats: int = 3) -> dict:
+    """ Start-up latency of predict.py, the entrypoint of the Docker image, each time in
+    a new interpreter: the import of torch alone, the imports of predict.py and a
+    prediction of the test dataset end to end. Also lists the training-only modules
+    imported by predict.py
+    """
+    if not model_path.exists():
+        model = main.get_instance(module_arch, 'arch', cfg)
+        torch.save({'arch': type(model).__name__, 'state_dict': model.state_dict()},
+                    model_path)
+
+    imports = ('import sys, json\n'
+                'from challenge import main\n'
+                'from challenge.cli import load_config\n'
+                f'print(json.dumps([m for m in {TRAINING_MODULES} '
+                f'if m in sys.modules]))')
+    entrypoint = Path(main.__file__).parent / 'predict.py'
+
+    torch_seconds, import_seconds, predict_seconds = [], [], []
+    with tempfile.TemporaryDirectory() as directory:
+        # predict.py reads config.yml and the model from the working directory
+        with open(Path(directory) / 'config.yml', 'w') as handle:
+            yaml.safe_dump(cfg, handle)
+        os.symlink(model_path.resolve(), Path(directory) / 'model.pth')
+
+        for _ in range(repeats):
+            torch_seconds.append(_run_python(['-c', 'import torch'])[0])
+            seconds, output = _run_python(['-c', imports])
+            import_seconds.append(seconds)
+            args = [str(entrypoint), '--data', str(data_path.resolve())]
+            predict_seconds.append(_run_python(args, directory)[0])
+
+    return {
+        'torch_import_seconds': float(np.median(torch_seconds)),
+        'import_seconds': float(np.median(import_seconds)),
+        'predict_seconds': float(np.median(predict_seconds)),
+        'training_modules': json.loads(output)
+    }
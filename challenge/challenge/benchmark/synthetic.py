@@ -0,0 +1,116 @@
+import os
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from challenge.utils import setup_logger
+from challenge.utils.storage import DATA_KEY, IDS_KEY, N_ENCODING, N_FEATURES, N_Q8
+
+
+log = setup_logger(__name__)
+
+LENGTH_DISTRIBUTIONS = ['lognormal', 'uniform', 'fixed']
+
+# label channels after the Q8 classes, like the remaining labels of the ESM1b datasets
+N_EXTRA_LABELS = 7
+
+# proteins generated at a time
+CHUNK_PROTEINS = 64
+
+# seed of the class prototypes, shared by every dataset so that a model trained on one
+# dataset applies to the others
+PROTOTYPE_SEED = 0
+
+
+def protein_lengths(n_proteins: int, max_length: int, distribution: str = 'lognormal',
+                        min_length: int = 20, seed: int = 0) -> np.ndarray:
+    """ Returns random protein lengths
+    Args:
+        n_proteins: number of proteins
+        max_length: longest protein, the proteins are padded to it
+        distribution: 'lognormal' skews to short proteins with a long tail like real
+            datasets, 'uniform' draws between min_length and max_length, 'fixed' uses
+            max_length
+        min_length: shortest protein
+        seed: seed of the lengths
+    """
+    if distribution not in LENGTH_DISTRIBUTIONS:
+        raise ValueError(f'Unknown length distribution "{distribution}", '
+                            f'expected one of {LENGTH_DISTRIBUTIONS}')
+
+    rng = np.random.RandomState(seed)
+    min_length = min(min_length, max_length)
+
+    if distribution == 'fixed':
+        return np.full(n_proteins, max_length)
+    if distribution == 'uniform':
+        return rng.randint(min_length, max_length + 1, n_proteins)
+
+    # median of a third of the longest protein
+    lengths = rng.lognormal(np.log(max_length / 3), 0.5, n_proteins)
+    return np.clip(lengths.astype(int), min_length, max_length)
+
+
+def make_dataset(path: str, n_proteins: int = 256, max_length: int = 400,
+                    distribution: str = 'lognormal', signal: float = 0.5,
+                    seed: int = 0) -> Path:
+    """ Writes a synthetic ``.npz`` dataset in the (proteins, residues, channels)
+    layout of the ESM1b datasets read by DatasetBase: the one-hot amino acids, the
+    embedding, the mask, the one-hot Q8 class and the remaining labels, with the
+    identifiers of the proteins. The proteins are written a chunk at a time, so datasets
+    larger than memory can be generated.
+    Args:
+        path: file path of the dataset
+        n_proteins: number of proteins
+        max_length: longest protein, the proteins are padded to it
+        distribution: distribution of the protein lengths, see protein_lengths
+        signal: scale of the part of the embedding that depends on the Q8 class, which
+            makes the classes learnable. 0 gives random labels
+        seed: seed of the lengths and residues of the dataset, the class prototypes are
+            the same for every seed
+    Returns:
+        path of the dataset
+    """
+    path = Path(path)
+    lengths = protein_lengths(n_proteins, max_length, distribution, seed=seed)
+    rng = np.random.RandomState(seed)
+
+    # direction of the embedding of each Q8 class
+    n_embedding = N_FEATURES - N_ENCODING
+    prototypes = np.random.RandomState(PROTOTYPE_SEED).randn(N_Q8, n_embedding)
+    prototypes = prototypes.astype(np.float32) * signal
+
+    n_channels = N_FEATURES + 1 + N_Q8 + N_EXTRA_LABELS
+    log.info(f'Generating {n_proteins} proteins of at most {max_length} residues '
+                f'in {path}')
+
+    tmp_path = path.with_name(path.name + '.npy.tmp')
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                        shape=(n_proteins, max_length, n_channels))
+    for start in range(0, n_proteins, CHUNK_PROTEINS):
+        n_chunk = min(CHUNK_PROTEINS, n_proteins - start)
+        chunk = np.zeros((n_chunk, max_length, n_channels), dtype=np.float32)
+        for i, length in enumerate(lengths[start:start + len(chunk)]):
+            residues = np.arange(length)
+            q8 = rng.randint(0, N_Q8, length)
+
+            chunk[i, residues, rng.randint(0, N_ENCODING, length)] = 1
+            chunk[i, :length, N_ENCODING:N_FEATURES] = (
+                rng.randn(length, n_embedding).astype(np.float32) + prototypes[q8])
+            chunk[i, :length, N_FEATURES] = 1
+            chunk[i, residues, N_FEATURES + 1 + q8] = 1
+            chunk[i, :length, N_FEATURES + 1 + N_Q8:] = rng.rand(length, N_EXTRA_LABELS)
+        data[start:start + len(chunk)] = chunk
+    data.flush()
+    del data
+
+    # stored without compression like np.savez, the array is copied into the archive in
+    # chunks
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        archive.write(tmp_path, f'{DATA_KEY}.npy')
+        with archive.open(f'{IDS_KEY}.npy', 'w') as fh:
+            np.save(fh, np.array([f'{path.stem}_{i}' for i in range(n_proteins)]))
+    os.remove(tmp_path)
+
+    return path
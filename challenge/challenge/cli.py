@@ -1,4 +1,5 @@
 import click
+import torch
 import yaml
 
 from challenge import main
@@ -23,30 +24,327 @@ def cli():
     )
 )
 @click.option('-r', '--resume', default=None, type=str, help='path to checkpoint')
-def train(config_filename: str, resume: str):
+@click.option('--nprocs', default=1, type=int, help='Training processes per node')
+@click.option('--nnodes', default=1, type=int, help='Nodes of a distributed run')
+@click.option(
+    '--node-rank',
+    default=0,
+    type=int,
+    help='Rank of this node, 0 runs the evaluation'
+)
+@click.option('--master-addr', default='127.0.0.1', type=str, help='Address of node 0')
+@click.option('--master-port', default=29500, type=int, help='Free port on node 0')
+def train(config_filename: str, resume: str, nprocs: int, nnodes: int, node_rank: int,
+            master_addr: str, master_port: int):
     """ Entry point to start training run(s). """
     configs = [load_config(f) for f in config_filename]
     for config in configs:
-        setup_logging(config)
-        main.train(config, resume)
+        if nprocs * nnodes > 1:
+            # distributed data parallel training, one process per model replica
+            torch.multiprocessing.spawn(
+                main.train_worker, nprocs=nprocs,
+                args=(config, resume, nprocs, nnodes, node_rank, master_addr,
+                        master_port))
+        else:
+            setup_logging(config)
+            main.train(config, resume)
 
 
 @cli.command()
-@click.option('-c', '--config-filename', default=['experiments/config.yml'], help='Path to model configuration file.')
+@click.option(
+    '-c',
+    '--config-filename',
+    default='experiments/config.yml',
+    help='Path to model configuration file.'
+)
 @click.option('-m', '--model_path', default='model.pth', type=str, help='Path to trained model')
 @click.option('-i', '--test_path', default=None, type=str, help='Path to test data')
-def eval(config_filename: str, model_path: str, test_path: str):
+@click.option(
+    '--compare-dtype',
+    default=None,
+    type=click.Choice(['float32', 'float16', 'bfloat16']),
+    help=(
+        'Evaluate again with the input features stored in this precision and report '
+        'the difference'
+    )
+)
+@click.option(
+    '-s',
+    '--split-path',
+    default=None,
+    type=str,
+    help='Path to split.npz of a training run, to also evaluate its validation data'
+)
+def eval(config_filename: str, model_path: str, test_path: str, compare_dtype: str,
+            split_path: str):
     config = load_config(config_filename)
-    main.eval(config, model_path, test_path)
+    main.eval(config, model_path, test_path, compare_dtype, split_path)
 
 
 @cli.command()
 @click.option('-c', '--config-filename', default='config.yml', help='Path to model configuration file.')
 @click.option('-m', '--model_path', default='model.pth', type=str, help='Path to trained model')
 @click.option('-i', '--data', default=None, type=str, help='Path to prediction data')
-def predict(config_filename: str, model_path: str, data: str):
+@click.option(
+    '--quantize',
+    default=None,
+    type=click.Choice(['int8']),
+    help='Quantize the Linear layers for CPU inference and report the agreement '
+         'with the float model'
+)
+@click.option(
+    '--batch-size',
+    default=None,
+    type=int,
+    help='Proteins per batch, batch_size of the configuration by default'
+)
+@click.option(
+    '--max-residues',
+    default=None,
+    type=int,
+    help='Largest number of padded residues per batch'
+)
+@click.option(
+    '-f',
+    '--format',
+    'output_format',
+    default='csv',
+    type=click.Choice(['csv', 'fasta', 'npz', 'parquet']),
+    help='Format of the predictions'
+)
+@click.option(
+    '-o',
+    '--output',
+    default=None,
+    type=str,
+    help='Path of the predictions, predictions.<format> by default'
+)
+@click.option(
+    '--probabilities',
+    is_flag=True,
+    help='Also write the class probabilities (npz and parquet)'
+)
+def predict(config_filename: str, model_path: str, data: str, quantize: str,
+            batch_size: int, max_residues: int, output_format: str, output: str,
+            probabilities: bool):
+    config = load_config(config_filename)
+    main.predict(config, model_path, data, quantize, batch_size, max_residues,
+                    output_format, output, probabilities)
+
+
+@cli.command()
+@click.option(
+    '-c',
+    '--config-filename',
+    default='experiments/config.yml',
+    help='Path to model configuration file.'
+)
+@click.option(
+    '-m',
+    '--model_path',
+    default='model.pth',
+    type=str,
+    help='Path to trained model'
+)
+@click.option(
+    '-o',
+    '--output',
+    default='model.pt',
+    type=str,
+    help='Path of the exported model'
+)
+@click.option(
+    '--quantize',
+    default=None,
+    type=click.Choice(['int8']),
+    help='Quantize the Linear layers of the exported model for CPU inference'
+)
+def export(config_filename: str, model_path: str, output: str, quantize: str):
+    """ Exports a trained model into an inference-only TorchScript file for predict. """
+    config = load_config(config_filename)
+    main.export(config, model_path, output, quantize)
+
+
+@cli.command()
+@click.option(
+    '-c',
+    '--config-filename',
+    default='config.yml',
+    help='Path to model configuration file.'
+)
+@click.option(
+    '-m',
+    '--model_path',
+    default='model.pth',
+    type=str,
+    help='Path to trained model'
+)
+@click.option(
+    '--host',
+    default='127.0.0.1',
+    type=str,
+    help='Address of the HTTP endpoint'
+)
+@click.option('--port', default=8000, type=int, help='Port of the HTTP endpoint')
+@click.option(
+    '--socket',
+    default=None,
+    type=str,
+    help='Serve JSON lines on this Unix socket instead of HTTP'
+)
+@click.option(
+    '--stdin',
+    is_flag=True,
+    help='Answer JSON lines of stdin on stdout instead of HTTP'
+)
+@click.option(
+    '--max-batch-size',
+    default=32,
+    type=int,
+    help='Largest number of proteins per micro-batch'
+)
+@click.option(
+    '--max-residues',
+    default=None,
+    type=int,
+    help='Largest number of padded residues per micro-batch'
+)
+@click.option(
+    '--max-latency-ms',
+    default=5.0,
+    type=float,
+    help='Milliseconds a request waits for others to batch with'
+)
+@click.option(
+    '--reload-interval',
+    default=2.0,
+    type=float,
+    help='Seconds between checks of the model file, 0 disables reloading'
+)
+def serve(config_filename: str, model_path: str, host: str, port: int, socket: str,
+            stdin: bool, max_batch_size: int, max_residues: int, max_latency_ms: float,
+            reload_interval: float):
+    """ Serves predictions of a model loaded once, batching concurrent requests. """
+    config = load_config(config_filename)
+    main.serve(config, model_path, host, port, socket, stdin, max_batch_size,
+                max_residues, max_latency_ms / 1000, reload_interval)
+
+
+@cli.command()
+@click.option(
+    '-i',
+    '--input',
+    'inputs',
+    multiple=True,
+    required=True,
+    help='Path to dataset(s) to convert'
+)
+@click.option(
+    '-o',
+    '--output',
+    required=True,
+    type=str,
+    help='Directory of the converted dataset'
+)
+@click.option(
+    '--dtype',
+    default='float32',
+    type=click.Choice(['float32', 'float16', 'bfloat16']),
+    help='Precision of the stored embedding'
+)
+@click.option(
+    '--shard-size',
+    default=1000,
+    type=int,
+    help='Number of proteins per shard'
+)
+def convert(inputs: list, output: str, dtype: str, shard_size: int):
+    """ Converts datasets once into the optimized format of the dataset loaders. """
+    main.convert(list(inputs), output, dtype, shard_size)
+
+
+@cli.command()
+@click.option(
+    '-c',
+    '--config-filename',
+    default='experiments/config.yml',
+    help='Path to configuration file.'
+)
+@click.option(
+    '-o',
+    '--output',
+    default='benchmark.json',
+    type=str,
+    help='Path of the JSON results'
+)
+@click.option(
+    '-b',
+    '--baseline',
+    default=None,
+    type=str,
+    help='JSON results of a previous run to compare with'
+)
+@click.option(
+    '--proteins',
+    default=256,
+    type=int,
+    help='Number of proteins of the synthetic training data'
+)
+@click.option(
+    '--max-length',
+    default=400,
+    type=int,
+    help='Longest protein of the synthetic data'
+)
+@click.option(
+    '--lengths',
+    default='lognormal',
+    type=click.Choice(['lognormal', 'uniform', 'fixed']),
+    help='Distribution of the protein lengths'
+)
+@click.option(
+    '--steps',
+    default=20,
+    type=int,
+    help='Number of timed training and evaluation steps'
+)
+@click.option(
+    '--target-accuracy',
+    default=0.9,
+    type=float,
+    help='Q8 accuracy of time_to_accuracy'
+)
+@click.option(
+    '--max-epochs',
+    default=20,
+    type=int,
+    help='Epochs after which time_to_accuracy stops'
+)
+@click.option(
+    '--only',
+    multiple=True,
+    type=click.Choice(['load', 'loader', 'train_step', 'eval_step', 'time_to_accuracy',
+                        'predict', 'cold_start']),
+    help='Benchmarks to run, all by default'
+)
+@click.option(
+    '--data-dir',
+    default=None,
+    type=str,
+    help='Directory to keep and reuse the synthetic data'
+)
+def benchmark(config_filename: str, output: str, baseline: str, proteins: int,
+                max_length: int, lengths: str, steps: int, target_accuracy: float,
+                max_epochs: int, only: list, data_dir: str):
+    """ Benchmarks loading, training, evaluation and prediction on synthetic data. """
+    # imported here, so the prediction entrypoint does not import the benchmarks
+    from challenge import benchmark as module_benchmark
+
     config = load_config(config_filename)
-    main.predict(config, model_path, data)
+    setup_logging(config)
+    module_benchmark.run_benchmarks(config, output, baseline, proteins, max_length,
+                                    lengths, steps, target_accuracy, max_epochs,
+                                    list(only), data_dir)
 
 
 def load_config(filename: str) -> dict:
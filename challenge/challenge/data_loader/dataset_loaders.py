@@ -9,14 +9,14 @@ class ChallengeData(DatasetBase):
 
 
 class ChallengeDataOnlyEncoding(DatasetBase):
+    channels = slice(0, 20)
+
     def __init__(self, *args, **kwargs):
         super(ChallengeDataOnlyEncoding, self).__init__(*args, **kwargs)
 
-        self.X = self.X[:, :, :20]
-
 
 class ChallengeDataOnlyEmbedding(DatasetBase):
+    channels = slice(20, 1300)
+
     def __init__(self, *args, **kwargs):
         super(ChallengeDataOnlyEmbedding, self).__init__(*args, **kwargs)
-
-        self.X = self.X[:, :, 20:1300]
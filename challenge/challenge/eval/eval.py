@@ -3,13 +3,20 @@ import torch.nn as nn
 import numpy as np
 
 from torch.utils.data import DataLoader
-from challenge.base import EvaluateBase, AverageMeter
+from challenge.base import EvaluateBase
+from challenge.models.metric import MetricTracker
+from challenge.utils import setup_logger, check_precision, autocast
+
+
+log = setup_logger(__name__)
 
 class Evaluate(EvaluateBase):
     """ Responsible for test evaluation and the metrics. """
 
     def __init__(self, model: nn.Module, metrics: list, metrics_task: list, device: torch.device,
-            test_data_loader: list, batch_transform: callable = None, checkpoint_dir: str = None, model_path: str = None, writer_dir: str = None):
+            test_data_loader: list, batch_transform: callable = None,
+            checkpoint_dir: str = None, model_path: str = None, writer_dir: str = None,
+            precision: str = 'float32'):
         super().__init__(model, metrics, metrics_task, device, checkpoint_dir, model_path, writer_dir)
         """ Constructor
         Args:
@@ -21,27 +28,45 @@ class Evaluate(EvaluateBase):
             writer_dir: directory to write evaluation
             device: device for the tensors
             test_data_loader: list Dataloader containing the test data
+            precision: precision of the forward pass, 'float32', 'bfloat16' or 'float16'
         """
         
         self.path = test_data_loader[0]
         self.test_data_loader = test_data_loader[1]
         self.batch_transform = batch_transform
+        self.precision = precision
+        check_precision(precision, device)
     
     def _evaluate_epoch(self) -> dict:
         """ Evaluation of test """
 
         self.model.eval()
 
-        metric_mtrs = [AverageMeter(m.__name__) for m in self.metrics]
+        metrics = MetricTracker(self.metrics, self.metrics_task)
+
+        # metrics of a float32 forward pass, to report the accuracy lost in precision
+        reference = None
+        if self.precision != 'float32':
+            reference = MetricTracker(self.metrics, self.metrics_task)
+
         # get test evaluation from metrics
         with torch.no_grad():
             for batch_idx, (data, target, mask) in enumerate(self.test_data_loader):
                 if self.batch_transform:
                     data = self.batch_transform(data)
-                data, target = data.to(self.device), target.to(self.device)
-                output = self.model(data, mask)
-                for mtr, value in zip(metric_mtrs, self._eval_metrics(output, target)):
-                    mtr.update(value, data.size(0))
+                data = data.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
+                with autocast(self.precision, self.device):
+                    output = self.model(data, mask)
+                metrics.update(output, target)
+                if reference is not None:
+                    reference.update(self.model(data, mask), target)
+
+        if reference is not None:
+            results = zip(self.metrics, metrics.result(), reference.result())
+            for metric, value, full in results:
+                log.info(f'{metric.__name__} {self.precision}: {value:.6f} '
+                            f'float32: {full:.6f} delta: {value - full:+.6f}')
 
         # cleanup
         del data
@@ -49,27 +74,14 @@ class Evaluate(EvaluateBase):
         del output
         torch.cuda.empty_cache()
 
-        # return results
+        # return results, with the precision and recall of each class
         results = {}
-        for mtr in metric_mtrs:
-            results[mtr.name] = mtr.avg
+        for metric, value in zip(self.metrics, metrics.result()):
+            results[metric.__name__] = value
+        results.update(metrics.per_class())
 
         return results
 
-    def _eval_metrics(self, output: torch.tensor, target: torch.tensor) -> float:
-        """ Evaluation of metrics 
-        Args:
-            output: tensor with output values from the model
-            target: tensor with target values
-        """
-
-        with torch.no_grad():
-            i = 0
-            for metric in self.metrics:
-                value = metric(output[self.metrics_task[i]], target)
-                i += 1
-                yield value
-
     def _write_test(self):
         """ Write test results """
 
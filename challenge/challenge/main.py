@@ -1,15 +1,20 @@
 import os
-import pdb
+import sys
+import logging
+import itertools
 import random
-from typing import Any, List, Tuple, Dict
+from functools import partial
+from pathlib import Path
+from typing import Any, List, Tuple, Dict, Iterable
 from types import ModuleType
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.optim as module_optimizer
 import torch.optim.lr_scheduler as module_scheduler
+from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
 
 import challenge.data_loader.augmentation as module_aug
 import challenge.data_loader.data_loaders as module_data
@@ -18,13 +23,39 @@ import challenge.models.loss as module_loss
 import challenge.models.metric as module_metric
 import challenge.models as module_arch
 
-from challenge.trainer import Trainer
+from challenge.base import stream_batches
 from challenge.eval import Evaluate
-from challenge.utils import setup_logger
+from challenge.utils import (
+    setup_logger,
+    setup_logging,
+    convert_dataset,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    get_local_rank,
+    export_model,
+    load_exported,
+    is_exported,
+    quantize,
+    compare_quantized,
+    BackgroundIterator,
+    BackgroundWorker,
+    prediction_writer,
+    read_ids
+)
+from challenge.utils.storage import N_FEATURES
+from challenge.models.metric import Q8_CLASSES, Q3_CLASSES
 
 
 log = setup_logger(__name__)
 
+# batches of the input predicted by both the float and the quantized model to compare
+# them
+QUANTIZATION_SAMPLE = 8
+
+# batches read ahead of the model and predicted batches waiting to be written
+PREDICT_QUEUE = 4
+
 
 def train(cfg: dict, resume: str):
     """ Loads configuration and trains and evaluates a model
@@ -32,12 +63,24 @@ def train(cfg: dict, resume: str):
         cfg: dictionary containing the configuration of the experiment
         resume: path to previous resumed model
     """
+    # the trainer and its dependencies are imported by the training commands only, so
+    # that predict starts faster
+    from challenge.trainer import Trainer
+
     log.debug(f'Training: {cfg}')
     seed_everything(cfg['seed'])
 
+    # reuse the training and validation split of the resumed run
+    split_path = Path(resume).parent / 'split.npz' if resume else None
+    if split_path and split_path.exists():
+        cfg['data_loader']['args'].setdefault('split_path', str(split_path))
+
     model = get_instance(module_arch, 'arch', cfg)
 
-    model, device = setup_device(model, cfg['target_devices'])
+    if is_distributed():
+        model, device = setup_distributed_device(model, cfg['target_devices'])
+    else:
+        model, device = setup_device(model, cfg['target_devices'])
     torch.backends.cudnn.benchmark = True  # disable if not consistent input sizes
 
     param_groups = setup_param_groups(model, cfg['optimizer'])
@@ -45,13 +88,20 @@ def train(cfg: dict, resume: str):
     lr_scheduler = get_instance(module_scheduler, 'lr_scheduler', cfg, optimizer)
     model, optimizer, start_epoch = resume_checkpoint(resume, model, optimizer, cfg)
 
+    # every process starts from the parameters of the main process and averages the
+    # gradients
+    if is_distributed():
+        model = DistributedDataParallel(
+            model, device_ids=[device.index] if device.type == 'cuda' else None,
+            broadcast_buffers=False)
+
     transforms = get_instance(module_aug, 'augmentation', cfg)
     data_loader = get_instance(module_data, 'data_loader', cfg)
     valid_data_loader = data_loader.split_validation()
-    test_data_loader = data_loader.get_test()
+    test_data_loader = data_loader.get_test() if is_main_process() else []
 
     log.info('Getting loss and metric function handles')
-    loss = getattr(module_loss, cfg['loss'])
+    loss = get_loss(cfg['loss'])
 
     metrics = [getattr(module_metric, met) for met, _ in cfg['metrics'].items()]
     metrics_task = [task for _, task in cfg['metrics'].items()]
@@ -68,25 +118,66 @@ def train(cfg: dict, resume: str):
 
     trainer.train()
 
+    # the test datasets are evaluated once, by the main process
+    if not is_main_process():
+        return
+
     log.info('Initialising evaluation')
 
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+
     for _test_data_loader in test_data_loader:
         evaluation = Evaluate(model, metrics, metrics_task,
                                 batch_transform=transforms,
                                 device=device,
                                 test_data_loader=_test_data_loader,
                                 checkpoint_dir=trainer.checkpoint_dir,
-                                writer_dir=trainer.writer_dir)
+                                writer_dir=trainer.writer_dir,
+                                precision=trainer.precision)
         evaluation.evaluate()
 
     log.info('Finished!')
 
 
-def eval(cfg: dict, model_path: str, test_path: str):
+def train_worker(local_rank: int, cfg: dict, resume: str, nprocs: int, nnodes: int,
+                    node_rank: int, master_addr: str, master_port: int):
+    """ Trains in one process of a distributed run
+    Args:
+        local_rank: rank of the process on its node
+        cfg: dictionary containing the configuration of the experiment
+        resume: path to previous resumed model
+        nprocs: number of processes per node
+        nnodes: number of nodes
+        node_rank: rank of the node
+        master_addr: address of the node of rank 0
+        master_port: free port on the node of rank 0
+    """
+    rank = node_rank * nprocs + local_rank
+    init_distributed(rank, nprocs * nnodes, local_rank, master_addr, master_port)
+
+    # only the main process logs progress, the processes of a node share its cores
+    setup_logging(cfg)
+    if rank != 0:
+        logging.disable(logging.INFO)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // nprocs))
+
+    try:
+        train(cfg, resume)
+    finally:
+        dist.destroy_process_group()
+
+
+def eval(cfg: dict, model_path: str, test_path: str, compare_dtype: str = None,
+            split_path: str = None):
     """ Eval using trained model and test file
     Args:
         cfg: configuration of model
         model_path: path to trained model
+        test_path: path to test data, replaces the test data of the configuration
+        split_path: split.npz of a training run, also evaluates its validation data
+        compare_dtype: evaluates again with the input features stored in this precision
+            and reports the difference of the metrics
     """
     # load model and predict
 
@@ -97,67 +188,300 @@ def eval(cfg: dict, model_path: str, test_path: str):
     model, device = setup_device(model, cfg['target_devices'])
     torch.backends.cudnn.benchmark = True  # disable if not consistent input sizes
 
-    # remove train data from configuration
-    cfg['data_loader']['args']['train_path'] = None
+    # remove train data from configuration, unless the validation split is evaluated
+    if split_path:
+        cfg['data_loader']['args']['split_path'] = split_path
+    else:
+        cfg['data_loader']['args']['train_path'] = None
 
     if test_path:
         cfg['data_loader']['args']['test_path'] = [test_path]
 
+    metrics = [getattr(module_metric, met) for met, _ in cfg['metrics'].items()]
+    metrics_task = [task for _, task in cfg['metrics'].items()]
+
+    evaluations = evaluate_test(cfg, model, metrics, metrics_task, device, model_path)
+
+    if compare_dtype:
+        dataset_args = cfg['data_loader']['args'].setdefault('dataset_args', {})
+        dtype = dataset_args.get('dtype', 'float32')
+        dataset_args['dtype'] = compare_dtype
+
+        compared = evaluate_test(cfg, model, metrics, metrics_task, device, model_path)
+
+        for (path, results), (_, compared_results) in zip(evaluations, compared):
+            print(f'Precision report for {path}')
+            print(f'{"metric":15s} {dtype:>10s} {compare_dtype:>10s} {"delta":>10s}')
+            for metric, value in results.items():
+                compared_value = compared_results[metric]
+                print(f'{metric:15s} {value:10.6f} {compared_value:10.6f} '
+                        f'{compared_value - value:+10.6f}')
+
+
+def evaluate_test(cfg: dict, model: nn.Module, metrics: list, metrics_task: list,
+                    device: torch.device, model_path: str) -> list:
+    """ Evaluates a trained model on each test dataset of the configuration
+    Args:
+        cfg: configuration of model
+        model: model to evaluate
+        metrics: list with the metrics
+        metrics_task: list containing which model output corresponds to a metric
+        device: device for the tensors
+        model_path: path to trained model
+    Returns:
+        list of the test paths and their metrics
+    """
     transforms = get_instance(module_aug, 'augmentation', cfg)
     data_loader = get_instance(module_data, 'data_loader', cfg)
     test_data_loader = data_loader.get_test()
 
-    metrics = [getattr(module_metric, met) for met, _ in cfg['metrics'].items()]
-    metrics_task = [task for _, task in cfg['metrics'].items()]
+    valid_data_loader = data_loader.split_validation()
+    if valid_data_loader is not None:
+        test_data_loader.append(('validation', valid_data_loader))
 
+    evaluations = []
     for _test_data_loader in test_data_loader:
         evaluation = Evaluate(model, metrics, metrics_task,
                                 batch_transform=transforms,
                                 device=device,
                                 test_data_loader=_test_data_loader,
-                                model_path=model_path)
+                                model_path=model_path,
+                                precision=cfg['training'].get('precision', 'float32'))
         evaluation.evaluate()
+        evaluations.append((_test_data_loader[0], evaluation.evaluations))
+
+    return evaluations
 
 
-def predict(cfg: dict, model_path: str, data: str):
-    """ Predict using trained model and file or string input
+def predict(cfg: dict, model_path: str, data: str, quantization: str = None,
+                batch_size: int = None, max_residues: int = None,
+                output_format: str = 'csv', output: str = None,
+                probabilities: bool = False):
+    """ Predict using trained model and file or string input. The file is read in chunks
+    on a background thread and the predictions are written on another one while the
+    model predicts, so the memory is bounded by the chunks and batches in flight instead
+    of the file
     Args:
         cfg: configuration of model
         pred_name: name of the prediction class
         model_path: path to trained model
         data: file path to data
+        quantization: 'int8' quantizes the Linear layers of the model for CPU inference
+            and reports the agreement with the float model on a sample of the data
+        batch_size: proteins per batch, the batch_size of the configuration if None
+        max_residues: if set, largest number of padded residues of a batch, the
+            max_residues_per_batch of the configuration if None
+        output_format: 'csv', 'fasta', 'npz' or 'parquet'
+        output: file path of the predictions, predictions with the extension of the
+            format if None
+        probabilities: also writes the probabilities of the classes, for npz and parquet
     """
     with torch.no_grad():
         seed_everything(cfg['seed'])
         
-        # instantiate and load the model
+        model = load_model(cfg, model_path)
+
+        args = cfg['data_loader']['args']
+        batches = partial(
+            stream_batches, data, getattr(module_dataset, args['dataset_loader']),
+            args.get('dataset_args'), batch_size or args['batch_size'],
+            max_residues or args.get('max_residues_per_batch'))
+
+        if quantization:
+            float_model, model = model, quantize(model, quantization)
+            report_quantization(float_model, model, batches(), quantization)
+
+        # proteins are identified by the ids of the dataset, or by their index
+        ids = read_ids(data)
+        output = output or f'predictions.{output_format}'
+        predictions = prediction_writer(output_format, output,
+                                        {'q8': Q8_CLASSES, 'q3': Q3_CLASSES},
+                                        probabilities)
+
+        # a failed prediction removes its partial output instead of completing it
+        try:
+            # reading, prediction and writing overlap, each with a bounded queue of
+            # batches
+            reader = BackgroundIterator(batches(), PREDICT_QUEUE)
+            writer = BackgroundWorker(lambda batch: predictions.write(*batch),
+                                        PREDICT_QUEUE)
+            try:
+                # predict each batch and keep only the residues of the proteins
+                start = 0
+                for X, mask in reader:
+                    result = model(X, mask)[:2]
+                    residues = mask == 1
+
+                    batch_ids = [str(ids[i]) if ids is not None else str(i)
+                                    for i in range(start, start + X.size(0))]
+                    classes = [torch.argmax(output, dim=2)[residues]
+                                for output in result]
+                    probs = None
+                    if probabilities:
+                        probs = [torch.softmax(output.float(), dim=2)[residues]
+                                    for output in result]
+
+                    writer.submit((batch_ids, residues.sum(dim=1), classes, probs))
+                    start += X.size(0)
+            finally:
+                try:
+                    reader.close()
+                finally:
+                    writer.close()
+
+            predictions.close()
+        except BaseException:
+            predictions.abort()
+            raise
+
+    print(f'Predicted {predictions.residues} residues of {predictions.proteins} '
+            f'proteins into {output}')
+
+
+def load_model(cfg: dict, model_path: str) -> nn.Module:
+    """ Loads a trained model for inference on the CPU. Exported models are loaded
+    without the model classes, checkpoints into the model of the configuration
+    Args:
+        cfg: configuration of model
+        model_path: path to trained model, a checkpoint or a model written by export
+    Returns:
+        the model in evaluation mode
+    """
+    if is_exported(model_path):
+        model, _ = load_exported(model_path)
+    else:
         model = get_instance(module_arch, 'arch', cfg)
-        model_data = torch.load(model_path, map_location ='cpu')
+        model_data = torch.load(model_path, map_location='cpu')
         model.load_state_dict(model_data['state_dict'])
 
-        model.eval()
+    return model.eval()
 
-        dataset_loader = getattr(module_dataset, cfg['data_loader']['args']['dataset_loader'])
-        data = dataset_loader(data)
 
-        result = model(data.X, data.y[:, :, 0])
+def serve(cfg: dict, model_path: str, host: str = '127.0.0.1', port: int = 8000,
+            socket: str = None, stdin: bool = False, max_batch_size: int = 32,
+            max_residues: int = None, max_latency: float = 0.005,
+            reload_interval: float = 2.0):
+    """ Serves predictions of a model loaded once, the proteins of concurrent requests
+    are predicted together in micro-batches and the model is reloaded when its file
+    changes
+    Args:
+        cfg: configuration of model
+        model_path: path to trained model, a checkpoint or a model written by export
+        host: address of the HTTP endpoint
+        port: port of the HTTP endpoint
+        socket: if set, serves JSON lines on this Unix socket instead of HTTP
+        stdin: if set, answers the JSON lines of stdin on stdout instead of HTTP
+        max_batch_size: largest number of proteins of a micro-batch
+        max_residues: if set, largest number of padded residues of a micro-batch
+        max_latency: seconds the first protein of a micro-batch waits for more proteins
+        reload_interval: seconds between the checks of the model file, never reloaded
+            if 0
+    """
+    from challenge.serve import (
+        ModelHandle,
+        MicroBatcher,
+        serve_http,
+        serve_unix,
+        serve_stdin
+    )
+
+    # stdout carries the responses of stdin, the log goes to stderr
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    seed_everything(cfg['seed'])
 
-        mask = data.y[:, :, 0]
+    args = cfg['data_loader']['args']
+    dataset_loader = getattr(module_dataset, args['dataset_loader'])
+    n_features = len(range(N_FEATURES)[dataset_loader.channels])
 
-        # create predictions.csv
-        Q8, Q3 = "GHIBESTC", "HEC"
+    model = ModelHandle(model_path, partial(load_model, cfg))
+    if reload_interval:
+        model.watch(reload_interval)
+    batcher = MicroBatcher(model, n_features, max_batch_size, max_residues, max_latency)
 
-        q8 = np.array([Q8[val] for val in torch.argmax(result[0], dim=2)[mask == 1].flatten()])
-        q3 = np.array([Q3[val] for val in torch.argmax(result[1], dim=2)[mask == 1].flatten()])
+    if stdin:
+        serve_stdin(batcher)
+    elif socket:
+        serve_unix(batcher, socket)
+    else:
+        serve_http(batcher, host, port)
 
-        df = np.concatenate([np.expand_dims(q8, axis=1), np.expand_dims(q3, axis=1)], axis=1)
 
-        # save to file
-        df = pd.DataFrame(df)
-        df = df.set_axis(["q8", "q3"], axis=1, inplace=False)
-        df.to_csv('predictions.csv')
+def report_quantization(model: nn.Module, quantized: nn.Module, batches: Iterable,
+                            quantization: str):
+    """ Prints the agreement of the predictions of the quantized and the float model,
+    their latency and size on the first batches of the data
+    Args:
+        model: float model
+        quantized: quantized model
+        batches: (X, mask) batches of the data to predict
+        quantization: name of the quantization
+    """
+    batches = list(itertools.islice(batches, QUANTIZATION_SAMPLE))
+    report = compare_quantized(model, quantized, batches)
+
+    q8, q3 = report['agreement'][:2]
+    speedup = report['float_seconds'] / report['quantized_seconds']
+    print(f'Quantization report ({quantization}, {len(batches)} batches)')
+    print(f'Agreement with float32: q8 {q8:.4f} q3 {q3:.4f}')
+    print(f'Latency: float32 {report["float_seconds"]:.3f} s {quantization} '
+            f'{report["quantized_seconds"]:.3f} s ({speedup:.2f}x)')
+    print(f'Model size: float32 {report["float_bytes"] / 2 ** 20:.2f} MB '
+            f'{quantization} {report["quantized_bytes"] / 2 ** 20:.2f} MB')
+
+
+def export(cfg: dict, model_path: str, output: str, quantization: str = None):
+    """ Exports a trained model for inference, with only its weights and the layers
+    returned by its export method, as a TorchScript archive that predict loads without
+    the model classes
+    Args:
+        cfg: configuration of model
+        model_path: path to trained model
+        output: file path of the exported model
+        quantization: 'int8' quantizes the Linear layers of the exported model
+    """
+    model = get_instance(module_arch, 'arch', cfg)
+    model_data = torch.load(model_path, map_location='cpu')
+    model.load_state_dict(model_data['state_dict'])
+    model.eval()
+
+    # example batch with the input features of the dataset loader, to trace and check
+    # the model
+    args = cfg['data_loader']['args']
+    dataset_loader = getattr(module_dataset, args['dataset_loader'])
+    n_features = len(range(N_FEATURES)[dataset_loader.channels])
+    example = (torch.randn(2, 16, n_features), torch.ones(2, 16))
+
+    metadata = {
+        'arch': cfg['arch'],
+        'dataset_loader': cfg['data_loader']['args']['dataset_loader'],
+        'quantization': quantization,
+        'torch': torch.__version__
+    }
+
+    # a quantized model is checked against itself, its outputs differ from the float
+    # model
+    exported = model.export()
+    if quantization:
+        exported = quantize(exported, quantization)
+    path = export_model(exported, example, output, metadata,
+                        reference=exported if quantization else model)
+
+    print(f'Exported {type(model).__name__} from {model_path} to {path} '
+            f'({path.stat().st_size / 2 ** 20:.1f} MB)')
+
+
+def convert(paths: list, output: str, dtype: str, shard_size: int):
+    """ Converts datasets into the optimized format read by the dataset loaders
+    Args:
+        paths: file paths of the datasets
+        output: directory of the converted dataset
+        dtype: precision of the embedding
+        shard_size: number of proteins per shard
+    """
+    manifest = convert_dataset(paths, output, dtype, shard_size)
 
-    return print(df)
+    print(f'Converted {manifest["proteins"]} proteins ({manifest["residues"]} '
+            f'residues) into {len(manifest["shards"])} shard(s) in {output}')
 
 
 def setup_device(model: nn.Module, target_devices: List[int]) -> Tuple[torch.device, List[int]]:
@@ -202,6 +526,29 @@ def setup_device(model: nn.Module, target_devices: List[int]) -> Tuple[torch.dev
     return model, device
 
 
+def setup_distributed_device(
+        model: nn.Module, target_devices: List[int]) -> Tuple[nn.Module, torch.device]:
+    """ Setup the device of a process of a distributed run, each process of a node uses
+    the target device of its local rank or the CPU
+    Args:
+        model: Module to move to the device
+        target_devices: list of target devices
+    Returns:
+        the model on the device and the device
+    """
+    local_rank = get_local_rank()
+
+    available = torch.cuda.is_available()
+    if target_devices and local_rank < len(target_devices) and available:
+        device = torch.device(f'cuda:{target_devices[local_rank]}')
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    log.info(f'Process {local_rank} of the node uses device {device}')
+    return model.to(device), device
+
+
 def setup_param_groups(model: nn.Module, config: dict) -> list:
     """ Setup model parameters
     Args:
@@ -234,6 +581,19 @@ def resume_checkpoint(resume_path: str, model: nn.Module,
     return model, optimizer, checkpoint['epoch']
 
 
+def get_loss(config: Any) -> callable:
+    """ Returns the loss function of the configuration
+    Args:
+        config: name of the loss function, or a dictionary with its 'type' and 'args'
+    Returns:
+        the loss function, with the args of the configuration bound to it
+    """
+    if isinstance(config, str):
+        return getattr(module_loss, config)
+
+    return partial(getattr(module_loss, config['type']), **config.get('args', {}))
+
+
 def get_instance(module: ModuleType, name: str, config: Dict, *args: Any) -> Any:
     """ Helper to construct an instance of a class.
     Args
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from challenge.base import ModelBase
+from challenge.base import ModelBase, MergedLinear
 from challenge.utils import setup_logger
 
 
@@ -29,3 +29,10 @@ class Baseline(ModelBase):
         ss3 = self.ss3(x)
 
         return [ss8, ss3]
+
+    def export(self) -> nn.Module:
+        """ Returns the model for inference, with the q8 and q3 heads merged into one
+        projection
+        """
+
+        return MergedLinear([self.ss8, self.ss3])
@@ -1,7 +1,7 @@
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 
-from challenge.models.metric import get_mask
+from challenge.models.metric import get_mask, get_q8, get_q3
 
 
 def cross_entropy(outputs: torch.tensor, labels: torch.tensor, mask: torch.tensor) -> torch.tensor:
@@ -11,10 +11,9 @@ def cross_entropy(outputs: torch.tensor, labels: torch.tensor, mask: torch.tenso
         labels: tensor with labels
         mask: tensor with masking
     """
-    labels = labels.clone()
-    labels[mask == 0] = -1
+    labels = torch.where(mask == 1, labels, torch.full_like(labels, -1))
 
-    return nn.CrossEntropyLoss(ignore_index=-1)(outputs, labels.long())
+    return F.cross_entropy(outputs, labels, ignore_index=-1)
 
 
 def q8(outputs: torch.tensor, labels: torch.tensor) -> torch.tensor:
@@ -25,7 +24,7 @@ def q8(outputs: torch.tensor, labels: torch.tensor) -> torch.tensor:
     """
     mask = get_mask(labels)
 
-    labels = torch.argmax(labels[:, :, 1:9], dim=2)
+    labels = get_q8(labels)
     outputs = outputs.permute(0, 2, 1)
 
     return cross_entropy(outputs, labels, mask)
@@ -39,24 +38,29 @@ def q3(outputs: torch.tensor, labels: torch.tensor) -> torch.tensor:
     """
     mask = get_mask(labels)
 
-    # convert q8 to q3 class
-    structure_mask = torch.tensor([0, 0, 0, 1, 1, 2, 2, 2]).to(labels.device)
-    labels = torch.max(labels[:, :, 1:9] * structure_mask, dim=2)[0].long()
+    labels = get_q3(labels)
     outputs = outputs.permute(0, 2, 1)
 
     return cross_entropy(outputs, labels, mask)
 
 
-def secondary_structure_loss(outputs: torch.tensor, labels: torch.tensor) -> torch.tensor:
-    """ Returns a weighted double task loss for secondary structure. 
+def secondary_structure_loss(outputs: torch.tensor, labels: torch.tensor,
+                                weights: list = (1, 5)) -> torch.tensor:
+    """ Returns a weighted double task loss for secondary structure. The labels are
+    decoded and the residues of the proteins are selected once for both tasks.
     Args:
         outputs: tensor with psi predictions
         labels: tensor with labels
+        weights: weights of the q8 and q3 loss, set with the args of the loss
+            configuration
     """
-    # weighted losses
-    _q8 = q8(outputs[0], labels) * 1
-    _q3 = q3(outputs[1], labels) * 5
+    # residues of the proteins, padding is dropped before the loss of each task
+    residues = get_mask(labels) == 1
+    q8_labels = get_q8(labels)[residues]
+    q3_labels = get_q3(labels)[residues]
 
-    loss = torch.stack([_q8, _q3])
+    # weighted losses, residues without a class (-1) are ignored
+    _q8 = F.cross_entropy(outputs[0][residues], q8_labels, ignore_index=-1) * weights[0]
+    _q3 = F.cross_entropy(outputs[1][residues], q3_labels, ignore_index=-1) * weights[1]
 
-    return loss.sum()
+    return _q8 + _q3
@@ -1,16 +1,46 @@
 import torch
 import numpy as np
 
+from challenge.utils import all_reduce
+
+
+# secondary structure classes in the order of the labels and the model outputs
+Q8_CLASSES = 'GHIBESTC'
+Q3_CLASSES = 'HEC'
+
 
 def get_mask(labels: torch.tensor) -> torch.tensor:
     """ Returns mask from labels
     Args:
         labels: tensor containing labels
     """
-    labels = labels.clone()
-    zero_mask = labels[:, :, 0]
+    return labels[:, :, 0]
+
+
+def get_q8(labels: torch.tensor) -> torch.tensor:
+    """ Returns the Q8 class of each residue
+    Args:
+        labels: tensor with the one-hot labels of the dataset files, or compact labels
+            (mask, Q8 class, Q3 class) of datasets loaded with compact
+    """
+    if labels.is_floating_point():
+        return torch.argmax(labels[:, :, 1:9], dim=2)
+
+    return labels[:, :, 1].long()
+
+
+def get_q3(labels: torch.tensor) -> torch.tensor:
+    """ Returns the Q3 class of each residue
+    Args:
+        labels: tensor with the one-hot labels of the dataset files, or compact labels
+            (mask, Q8 class, Q3 class) of datasets loaded with compact
+    """
+    if labels.is_floating_point():
+        # convert q8 to q3 class
+        structure_mask = torch.tensor([0, 0, 0, 1, 1, 2, 2, 2]).to(labels.device)
+        return torch.max(labels[:, :, 1:9] * structure_mask, dim=2)[0].long()
 
-    return zero_mask
+    return labels[:, :, 2].long()
 
 
 def accuracy(pred: torch.tensor, labels: torch.tensor) -> float:
@@ -20,7 +50,7 @@ def accuracy(pred: torch.tensor, labels: torch.tensor) -> float:
         labels: tensor with correct values
     """
 
-    return (sum((pred == labels)) / len(labels)).item()
+    return (pred == labels).float().mean().item()
 
 
 def metric_q8(outputs: torch.tensor, labels: torch.tensor) -> float:
@@ -31,7 +61,7 @@ def metric_q8(outputs: torch.tensor, labels: torch.tensor) -> float:
     """
     mask = get_mask(labels)
 
-    labels = torch.argmax(labels[:, :, 1:9], dim=2)[mask == 1]
+    labels = get_q8(labels)[mask == 1]
     outputs = torch.argmax(outputs, dim=2)[mask == 1]
 
     return accuracy(outputs, labels)
@@ -45,9 +75,282 @@ def metric_q3(outputs: torch.tensor, labels: torch.tensor) -> float:
     """
     mask = get_mask(labels)
 
-    structure_mask = torch.tensor([0, 0, 0, 1, 1, 2, 2, 2]).to(labels.device)
-
-    labels = torch.max(labels[:, :, 1:9] * structure_mask, dim=2)[0].long()[mask == 1]
+    labels = get_q3(labels)[mask == 1]
     outputs = torch.argmax(outputs, dim=2)[mask == 1]
 
-    return accuracy(outputs, labels)
\ No newline at end of file
+    return accuracy(outputs, labels)
+
+
+def segment_overlap(pred: np.ndarray, labels: np.ndarray) -> float:
+    """ Returns the segment overlap score (SOV'99) of a protein between 0 and 1, which
+    rewards predicting the secondary structure segments instead of single residues
+    Args:
+        pred: predicted class of each residue
+        labels: correct class of each residue
+    """
+    obs_class, obs_start, obs_end = _segments(labels)
+    pred_class, pred_start, pred_end = _segments(pred)
+
+    # overlap of every observed segment (rows) with every predicted segment (columns)
+    obs_start, obs_end = obs_start[:, None], obs_end[:, None]
+    minov = np.minimum(obs_end, pred_end) - np.maximum(obs_start, pred_start)
+    maxov = np.maximum(obs_end, pred_end) - np.minimum(obs_start, pred_start)
+    overlapping = (obs_class[:, None] == pred_class) & (minov > 0)
+
+    obs_len = obs_end - obs_start
+    pred_len = (pred_end - pred_start)[None, :]
+    delta = np.minimum(maxov - minov, minov)
+    delta = np.minimum(delta, np.minimum(obs_len // 2, pred_len // 2))
+
+    score = np.where(overlapping, (minov + delta) / maxov * obs_len, 0).sum()
+
+    # observed segments count once per overlapping predicted segment, or once without
+    normalization = (obs_len[:, 0] * np.maximum(overlapping.sum(axis=1), 1)).sum()
+
+    return score / normalization
+
+
+def _segments(classes: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ Returns the class, start and end of each segment of residues of one class """
+    boundaries = np.flatnonzero(np.diff(classes)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(classes)]])
+
+    return classes[starts], starts, ends
+
+
+def sov_q8(outputs: torch.tensor, labels: torch.tensor) -> float:
+    """ Returns the q8 segment overlap
+    Args:
+        outputs: tensor with predicted values
+        labels: tensor with correct values
+    """
+    overlap = SegmentOverlap('q8')
+    overlap.update(outputs, labels)
+
+    return overlap.compute()
+
+
+def sov_q3(outputs: torch.tensor, labels: torch.tensor) -> float:
+    """ Returns the q3 segment overlap
+    Args:
+        outputs: tensor with predicted values
+        labels: tensor with correct values
+    """
+    overlap = SegmentOverlap('q3')
+    overlap.update(outputs, labels)
+
+    return overlap.compute()
+
+
+# labels each metric is computed from and how it is accumulated over an epoch
+EPOCH_METRICS = {
+    'metric_q8': ('q8', 'accuracy'),
+    'metric_q3': ('q3', 'accuracy'),
+    'sov_q8': ('q8', 'sov'),
+    'sov_q3': ('q3', 'sov')
+}
+DECODERS = {'q8': get_q8, 'q3': get_q3}
+CLASSES = {'q8': Q8_CLASSES, 'q3': Q3_CLASSES}
+
+
+def _bincount(index: torch.tensor, size: int) -> torch.tensor:
+    """ Returns the count of each value of the index, like torch.bincount with minlength
+    but without the synchronization with the host that torch.bincount needs on CUDA
+    Args:
+        index: values to count, below size
+        size: number of values
+    """
+    counts = torch.zeros(size, dtype=torch.long, device=index.device)
+
+    return counts.index_add_(0, index, torch.ones_like(index))
+
+
+class ConfusionMatrix:
+    """ Confusion matrix of the classes of all labelled residues, kept on the device """
+
+    def __init__(self, labels: str):
+        """ Constructor
+        Args:
+            labels: 'q8' or 'q3' classes
+        """
+        self.decode = DECODERS[labels]
+        self.n_classes = len(CLASSES[labels])
+        self.matrix = torch.zeros((self.n_classes, self.n_classes), dtype=torch.long)
+
+    def update(self, outputs: torch.tensor, labels: torch.tensor):
+        """ Adds the residues of a batch, with the correct classes as rows
+        Args:
+            outputs: tensor with predicted values
+            labels: tensor with correct values
+        """
+        n = self.n_classes
+        classes = self.decode(labels)
+        valid = (get_mask(labels) == 1) & (classes >= 0)
+
+        # residues that are not labelled are counted in an extra bin, which is dropped
+        index = torch.where(valid, classes * n + torch.argmax(outputs, dim=2),
+                            torch.full_like(classes, n * n))
+        counts = _bincount(index.flatten(), n * n + 1)[:-1].view(n, n)
+
+        self.matrix = self.matrix.to(counts.device) + counts
+
+    def synchronize(self):
+        """ Sums the matrices of all processes of a distributed run """
+        all_reduce(self.matrix)
+
+    def accuracy(self) -> float:
+        """ Returns the fraction of residues that are predicted correctly """
+        return (self.matrix.trace() / self.matrix.sum()).item()
+
+    def precision(self) -> np.ndarray:
+        """ Returns the fraction of correct residues of each predicted class """
+        return (self.matrix.diag() / self.matrix.sum(dim=0)).cpu().numpy()
+
+    def recall(self) -> np.ndarray:
+        """ Returns the fraction of the residues of each class predicted correctly """
+        return (self.matrix.diag() / self.matrix.sum(dim=1)).cpu().numpy()
+
+
+class SegmentOverlap:
+    """ Segment overlap of all proteins, the classes are on the device until the end """
+
+    def __init__(self, labels: str):
+        """ Constructor
+        Args:
+            labels: 'q8' or 'q3' classes
+        """
+        self.decode = DECODERS[labels]
+        self.batches = []
+        self.totals = None
+
+    def update(self, outputs: torch.tensor, labels: torch.tensor):
+        """ Adds the proteins of a batch
+        Args:
+            outputs: tensor with predicted values
+            labels: tensor with correct values
+        """
+        classes = self.decode(labels)
+        classes = torch.where(get_mask(labels) == 1, classes,
+                                torch.full_like(classes, -1))
+
+        predicted = torch.argmax(outputs, dim=2)
+        self.batches.append((predicted.to(torch.int8), classes.to(torch.int8)))
+
+    def _totals(self) -> torch.tensor:
+        """ Returns the sum of the segment overlap of the proteins and their number """
+        if self.totals is None:
+            scores = []
+            for outputs, classes in self.batches:
+                for pred, protein in zip(outputs.cpu().numpy(), classes.cpu().numpy()):
+                    labelled = protein >= 0
+                    if labelled.any():
+                        score = segment_overlap(pred[labelled], protein[labelled])
+                        scores.append(score)
+
+            self.totals = torch.tensor([sum(scores), len(scores)], dtype=torch.float64)
+            self.batches = []
+
+        return self.totals
+
+    def synchronize(self):
+        """ Sums the scores of all processes of a distributed run """
+        all_reduce(self._totals())
+
+    def compute(self) -> float:
+        """ Returns the mean segment overlap of the proteins """
+        total, count = self._totals().tolist()
+
+        return total / count if count else float('nan')
+
+
+class MetricTracker:
+    """ Accumulates the metrics over all batches of an epoch. The metrics of
+    EPOCH_METRICS are exact over all residues and proteins and are updated without
+    waiting for the device, other metrics are averaged over the batches weighted by the
+    number of proteins.
+    """
+
+    def __init__(self, metrics: list, metrics_task: list, distributed: bool = False):
+        """ Constructor
+        Args:
+            metrics: list with the metrics
+            metrics_task: list containing which model output corresponds to a metric
+            distributed: combines the batches of all processes of a distributed run, all
+                of them have to get the results
+        """
+        self.metrics = metrics
+        self.metrics_task = metrics_task
+        self.distributed = distributed
+
+        # metrics of the same labels and model output share the accumulator
+        self.accumulators = {}
+        for metric, task in zip(metrics, metrics_task):
+            if metric.__name__ in EPOCH_METRICS:
+                labels, kind = EPOCH_METRICS[metric.__name__]
+                if (labels, kind, task) not in self.accumulators:
+                    accumulator = (ConfusionMatrix if kind == 'accuracy'
+                                    else SegmentOverlap)
+                    self.accumulators[labels, kind, task] = accumulator(labels)
+
+        self.sums = [0.] * len(metrics)
+        self.count = 0
+
+    def update(self, output: list, target: torch.tensor):
+        """ Adds a batch
+        Args:
+            output: outputs of the model
+            target: labels matching the output
+        """
+        with torch.no_grad():
+            for (_, _, task), accumulator in self.accumulators.items():
+                accumulator.update(output[task], target)
+
+            for i, (metric, task) in enumerate(zip(self.metrics, self.metrics_task)):
+                if metric.__name__ not in EPOCH_METRICS:
+                    self.sums[i] += metric(output[task], target) * target.size(0)
+            self.count += target.size(0)
+
+    def _synchronize(self):
+        """ Combines the accumulators of all processes once """
+        if not self.distributed:
+            return
+
+        for accumulator in self.accumulators.values():
+            accumulator.synchronize()
+
+        totals = all_reduce(torch.tensor([*self.sums, self.count], dtype=torch.float64))
+        self.sums, self.count = totals[:-1].tolist(), totals[-1].item()
+        self.distributed = False
+
+    def result(self) -> list:
+        """ Returns the value of each metric """
+        self._synchronize()
+
+        values = []
+        for i, (metric, task) in enumerate(zip(self.metrics, self.metrics_task)):
+            if metric.__name__ in EPOCH_METRICS:
+                labels, kind = EPOCH_METRICS[metric.__name__]
+                accumulator = self.accumulators[labels, kind, task]
+                if kind == 'accuracy':
+                    values.append(accumulator.accuracy())
+                else:
+                    values.append(accumulator.compute())
+            else:
+                values.append(self.sums[i] / max(self.count, 1))
+
+        return values
+
+    def per_class(self) -> dict:
+        """ Returns the precision and recall of each class of the accuracy metrics """
+        self._synchronize()
+
+        values = {}
+        for (labels, kind, _), accumulator in self.accumulators.items():
+            if kind == 'accuracy':
+                for name, precision, recall in zip(
+                        CLASSES[labels], accumulator.precision(), accumulator.recall()):
+                    values[f'precision_{labels}_{name}'] = float(precision)
+                    values[f'recall_{labels}_{name}'] = float(recall)
+
+        return values
@@ -1,4 +1,5 @@
 import argparse
+import os
 from challenge import main
 from challenge.cli import load_config
 
@@ -7,7 +8,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--data', dest="data")
 args = parser.parse_args()
 
-config = load_config("config.yml")
-main.predict(config, "model.pth", args.data)
-
+# the exported model of the image is faster to load and run than the checkpoint
+model_path = "model.pt" if os.path.exists("model.pt") else "model.pth"
 
+config = load_config("config.yml")
+main.predict(config, model_path, args.data)
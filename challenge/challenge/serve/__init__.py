@@ -0,0 +1 @@
+from .server import ModelHandle, MicroBatcher, handle_message, serve_http, serve_unix, serve_stdin
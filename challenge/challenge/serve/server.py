@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from challenge.models.metric import Q8_CLASSES, Q3_CLASSES
+from challenge.utils import setup_logger
+
+
+log = setup_logger(__name__)
+
+# tasks of the model outputs and the letters of their classes
+TASKS = {'q8': Q8_CLASSES, 'q3': Q3_CLASSES}
+
+# seconds a request waits for its prediction before it fails
+REQUEST_TIMEOUT = 60
+
+
+class ModelHandle:
+    """ Keeps the model of a file loaded and replaces it when the file changes, the
+    model in use is swapped only once the new one has loaded
+    """
+
+    def __init__(self, path: str, load: callable):
+        """ Constructor
+        Args:
+            path: file path of the model
+            load: returns the model of a file path in evaluation mode
+        """
+        self.path = path
+        self.load = load
+        self.lock = threading.Lock()
+        self.model = None
+        self.mtime = None
+        self.reload()
+
+    def reload(self) -> bool:
+        """ Loads the model file, keeps the current model if it fails
+        Returns:
+            whether the model was loaded
+        """
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime
+            try:
+                model = self.load(self.path)
+            except Exception as error:
+                if self.model is None:
+                    raise
+                # retried once the file changes again
+                self.mtime = mtime
+                log.error(f'Reloading {self.path} failed, keeping the current model: '
+                            f'{error}')
+                return False
+
+            self.model, self.mtime = model, mtime
+            log.info(f'Loaded model {self.path}')
+            return True
+
+    def watch(self, interval: float):
+        """ Reloads the model on a background thread whenever its file is modified
+        Args:
+            interval: seconds between the checks of the file
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    modified = os.stat(self.path).st_mtime != self.mtime
+                except OSError:
+                    # the file is being replaced
+                    continue
+                if modified:
+                    self.reload()
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class MicroBatcher:
+    """ Predicts the proteins of concurrent requests together. A batch is predicted once
+    it is full or once its first protein waited for the deadline
+    """
+
+    def __init__(self, model: ModelHandle, n_features: int, max_batch_size: int = 32,
+                    max_residues: int = None, max_latency: float = 0.005):
+        """ Constructor
+        Args:
+            model: handle of the model
+            n_features: number of input features of each residue
+            max_batch_size: largest number of proteins of a batch
+            max_residues: if set, largest number of padded residues of a batch
+            max_latency: seconds the first protein of a batch waits for more proteins
+        """
+        self.model = model
+        self.n_features = n_features
+        self.max_batch_size = max_batch_size
+        self.max_residues = max_residues
+        self.max_latency = max_latency
+        self.tables = [np.frombuffer(letters.encode('ascii'), dtype='S1')
+                        for letters in TASKS.values()]
+
+        self.queue = queue.Queue()
+        self.pending = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, features, probabilities: bool = False) -> Future:
+        """ Queues a protein
+        Args:
+            features: (residues, features) input features of the protein
+            probabilities: also returns the probabilities of the classes
+        Returns:
+            future of the prediction of the protein
+        """
+        features = torch.as_tensor(np.asarray(features, dtype=np.float32))
+        if (features.dim() != 2 or features.size(1) != self.n_features
+                or not len(features)):
+            raise ValueError(f'Expected (residues, {self.n_features}) features, '
+                                f'got {tuple(features.shape)}')
+
+        future = Future()
+        self.queue.put((time.perf_counter(), features, probabilities, future))
+        return future
+
+    def _fits(self, batch: list, item: tuple) -> bool:
+        """ Returns whether a protein fits into the batch """
+        if len(batch) >= self.max_batch_size:
+            return False
+        if self.max_residues:
+            longest = max(len(item[1]), *(len(other[1]) for other in batch))
+            return (len(batch) + 1) * longest <= self.max_residues
+
+        return True
+
+    def _run(self):
+        """ Collects the proteins of each batch and predicts it """
+        while True:
+            first, self.pending = self.pending or self.queue.get(), None
+            batch = [first]
+            deadline = first[0] + self.max_latency
+
+            while True:
+                try:
+                    timeout = max(deadline - time.perf_counter(), 0)
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if not self._fits(batch, item):
+                    self.pending = item
+                    break
+                batch.append(item)
+
+            self._predict(batch)
+
+    def _predict(self, batch: list):
+        """ Predicts a batch and resolves the futures of its proteins """
+        try:
+            X = pad_sequence([item[1] for item in batch], batch_first=True)
+            mask = pad_sequence([torch.ones(len(item[1])) for item in batch],
+                                batch_first=True)
+            with torch.no_grad():
+                outputs = self.model.model(X, mask)[:len(TASKS)]
+
+            classes = [torch.argmax(output, dim=2).numpy() for output in outputs]
+            for i, (_, features, probabilities, future) in enumerate(batch):
+                length = len(features)
+                result = {
+                    task: table[indices[i, :length]].tobytes().decode('ascii')
+                    for task, table, indices in zip(TASKS, self.tables, classes)
+                }
+                if probabilities:
+                    for task, output in zip(TASKS, outputs):
+                        result[f'{task}_probabilities'] = \
+                            torch.softmax(output[i, :length].float(), dim=1).tolist()
+                future.set_result(result)
+        except Exception as error:
+            for item in batch:
+                if not item[3].done():
+                    item[3].set_exception(error)
+
+
+def handle_message(message: dict, batcher: MicroBatcher) -> dict:
+    """ Returns the response to a request
+    Args:
+        message: a protein ``{"id", "features", "probabilities"}``, several proteins
+            ``{"proteins": [...], "probabilities"}`` or a command
+            ``{"command": "reload"}`` or ``{"command": "health"}``
+        batcher: batcher of the predictions
+    """
+    if not isinstance(message, dict):
+        raise ValueError(f'Expected a JSON object, got {type(message).__name__}')
+
+    command = message.get('command')
+    if command == 'health':
+        return {'status': 'ok', 'model': batcher.model.path}
+    if command == 'reload':
+        return {'reloaded': batcher.model.reload(), 'model': batcher.model.path}
+    if command is not None:
+        raise ValueError(f'Unknown command "{command}", expected "health" or "reload"')
+
+    # every protein is submitted before waiting, so they are batched together
+    proteins = message['proteins'] if 'proteins' in message else [message]
+    probabilities = message.get('probabilities', False)
+    futures = [batcher.submit(protein['features'],
+                                protein.get('probabilities', probabilities))
+                for protein in proteins]
+    predictions = [{'id': protein.get('id'), **future.result(timeout=REQUEST_TIMEOUT)}
+                    for protein, future in zip(proteins, futures)]
+
+    return {'predictions': predictions} if 'proteins' in message else predictions[0]
+
+
+def _response(line: bytes, batcher: MicroBatcher) -> dict:
+    """ Returns the response to a JSON line, or the error it caused """
+    try:
+        return handle_message(json.loads(line), batcher)
+    except Exception as error:
+        return {'error': f'{type(error).__name__}: {error}'}
+
+
+def serve_http(batcher: MicroBatcher, host: str, port: int):
+    """ Serves POST /predict and /reload and GET /health over HTTP, a thread per
+    connection
+    Args:
+        batcher: batcher of the predictions
+        host: address to listen on
+        port: port to listen on
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, response: dict):
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self._send(404, {'error': f'Unknown path {self.path}'})
+            self._send(200, handle_message({'command': 'health'}, batcher))
+
+        def do_POST(self):
+            if self.path not in ('/predict', '/reload'):
+                return self._send(404, {'error': f'Unknown path {self.path}'})
+
+            if self.path == '/reload':
+                response = _response(b'{"command": "reload"}', batcher)
+            else:
+                length = int(self.headers.get('Content-Length', 0))
+                response = _response(self.rfile.read(length), batcher)
+            self._send(400 if 'error' in response else 200, response)
+
+        def log_message(self, format: str, *args):
+            log.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    log.info(f'Serving predictions on http://{host}:{server.server_port}')
+    server.serve_forever()
+
+
+def serve_unix(batcher: MicroBatcher, path: str):
+    """ Serves JSON lines over a Unix socket, a response line per request line and a
+    thread per connection
+    Args:
+        batcher: batcher of the predictions
+        path: file path of the socket
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    response = json.dumps(_response(line, batcher))
+                    self.wfile.write(response.encode() + b'\n')
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    log.info(f'Serving predictions on unix socket {path}')
+    server.serve_forever()
+
+
+def serve_stdin(batcher: MicroBatcher, workers: int = 16):
+    """ Answers the JSON lines of stdin on stdout in the same order. Up to workers lines
+    are handled at a time, so their proteins are batched together
+    Args:
+        batcher: batcher of the predictions
+        workers: number of lines handled concurrently
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(workers) as executor:
+        # the responses are written in order as they complete, at most workers lines
+        # ahead
+        responses = queue.Queue(maxsize=workers)
+
+        def write():
+            while True:
+                response = responses.get()
+                if response is None:
+                    return
+                sys.stdout.write(json.dumps(response.result()) + '\n')
+                sys.stdout.flush()
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        for line in sys.stdin:
+            if line.strip():
+                responses.put(executor.submit(_response, line, batcher))
+        responses.put(None)
+        writer.join()
@@ -1,9 +1,22 @@
+import contextlib
+
 import torch
 import numpy as np
 
-from torchvision.utils import make_grid
 from challenge.base import TrainerBase, AverageMeter
-from challenge.utils import setup_logger
+from challenge.utils import (
+    setup_logger,
+    check_precision,
+    autocast,
+    grad_scaler,
+    is_distributed,
+    is_main_process,
+    get_world_size,
+    all_reduce,
+    StepProfiler,
+    save_profile
+)
+from challenge.models.metric import MetricTracker, get_mask, get_q8
 
 log = setup_logger(__name__)
 
@@ -17,9 +30,34 @@ class Trainer(TrainerBase):
         self.valid_data_loader = valid_data_loader
         self.do_validation = self.valid_data_loader is not None
         self.lr_scheduler = lr_scheduler
-        self.log_step = int(np.sqrt(data_loader.batch_size)) * 8
+        # batch samplers, also those passed as sampler for batch_fetch, leave it unset
+        self.batch_size = data_loader.batch_size or (
+            data_loader.batch_sampler or data_loader.sampler).batch_size
+        self.log_step = int(np.sqrt(self.batch_size)) * 8
         self.batch_transform = batch_transform
 
+        # precision of the forward pass and the loss, gradients are scaled for float16
+        self.precision = config['training'].get('precision', 'float32')
+        check_precision(self.precision, device)
+        self.scaler = grad_scaler(self.precision)
+
+        # batches whose gradients are accumulated before each optimizer step
+        self.accumulation_steps = config['training'].get('accumulation_steps', 1)
+        if self.accumulation_steps > 1:
+            proteins = self.accumulation_steps * self.batch_size
+            log.info(f'Accumulating gradients over {self.accumulation_steps} batches, '
+                        f'{proteins:.0f} proteins per step')
+
+        # times the phases of the training steps, and traces steps of the first epoch
+        trace_steps = config['training'].get('profile_trace')
+        self.profiler = StepProfiler(
+            device, config['training'].get('profile', False),
+            trace_steps if is_main_process() else None, self.writer_dir / 'trace')
+
+        # resumed runs and later evaluations reuse the split with data_loader.split_path
+        if is_main_process():
+            self.data_loader.save_split(self.checkpoint_dir / 'split.npz')
+
     def _train_epoch(self, epoch: int) -> dict:
         """ Training logic for an epoch
         Args:
@@ -29,37 +67,84 @@ class Trainer(TrainerBase):
         """
         
         self.model.train()
+        self.data_loader.set_epoch(epoch)
 
+        # loss and metrics are accumulated on the device over every batch
         loss_mtr = AverageMeter('loss')
-        metric_mtrs = [AverageMeter(m.__name__) for m in self.metrics]
+        metrics = MetricTracker(self.metrics, self.metrics_task,
+                                distributed=is_distributed())
+
+        # labelled residues of the batches accumulated since the last optimizer step
+        accumulated, window_residues = 0, 0
+        self.optimizer.zero_grad()
+
+        self.profiler.reset()
+        if epoch == self.start_epoch:
+            self.profiler.start_trace()
 
         for batch_idx, (data, target, mask) in enumerate(self.data_loader):
             if self.batch_transform:
                 data = self.batch_transform(data)
+            self.profiler.mark('data')
+
+            with self.profiler.phase('h2d'):
+                data = data.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
+
+            # distributed processes only exchange the gradients of the last batch of a
+            # window
+            step = (accumulated + 1 == self.accumulation_steps
+                    or batch_idx + 1 == len(self.data_loader))
+            sync = contextlib.nullcontext()
+            if hasattr(self.model, 'no_sync') and not step:
+                sync = self.model.no_sync()
 
-            data, target = data.to(self.device), target.to(self.device)
+            # backpropagate using loss criterion, summed over the residues of the batch
+            # so the accumulated gradient is normalized by all residues of the window
+            with sync:
+                with self.profiler.phase('forward'):
+                    with autocast(self.precision, self.device):
+                        output = self.model(data, mask)
+                        loss = self.loss(output, target)
+                    residues = get_mask(target) == 1
+                    # the loss is averaged over the residues with a class, compact
+                    # labels mark the others with -1
+                    labelled = (residues & (get_q8(target) >= 0)).sum()
+                    residues = residues.sum()
+                with self.profiler.phase('backward'):
+                    self.scaler.scale(loss * labelled).backward()
 
-            # backpropagate using loss criterion
-            self.optimizer.zero_grad()
-            output = self.model(data, mask)
-            loss = self.loss(output, target)
-            loss.backward()
-            self.optimizer.step()
+            accumulated, window_residues = accumulated + 1, window_residues + labelled
+            if accumulated == self.accumulation_steps:
+                with self.profiler.phase('optimizer'):
+                    self._optimizer_step(window_residues)
+                accumulated, window_residues = 0, 0
 
             # write results and metrics 
-            loss_mtr.update(loss.item(), data.size(0))
-
-            if batch_idx % self.log_step == 0:
-                self.writer.set_step((epoch) * len(self.data_loader) + batch_idx)
-                self.writer.add_scalar('batch/loss', loss.item())
-                for mtr, value in zip(metric_mtrs, self._eval_metrics(output, target)):
-                    mtr.update(value, data.size(0))
-                    self.writer.add_scalar(f'batch/{mtr.name}', value)
-                self._log_batch(
-                    epoch, batch_idx, self.data_loader.batch_size,
-                    len(self.data_loader), loss.item()
-                )
+            with self.profiler.phase('metrics'):
+                loss_mtr.update(loss.detach(), data.size(0))
+                metrics.update(output, target)
+
+                if batch_idx % self.log_step == 0:
+                    self.writer.set_step((epoch) * len(self.data_loader) + batch_idx)
+                    self.writer.add_scalar('batch/loss', loss.item())
+                    for metric, value in zip(self.metrics,
+                                                self._eval_metrics(output, target)):
+                        self.writer.add_scalar(f'batch/{metric.__name__}', value)
+                    self._log_batch(
+                        epoch, batch_idx, self.batch_size,
+                        len(self.data_loader), loss.item()
+                    )
+            self.profiler.step(data.size(0), residues)
         
+        # the last batches of the epoch that did not fill a window
+        if accumulated:
+            with self.profiler.phase('optimizer'):
+                self._optimizer_step(window_residues)
+
+        self.profiler.stop_trace()
+        self._log_profile(epoch, self.profiler.summary())
+
         # cleanup
         del data
         del target
@@ -67,15 +152,17 @@ class Trainer(TrainerBase):
         torch.cuda.empty_cache()
 
         # write results
-        self.writer.add_scalar('epoch/loss', loss_mtr.avg)
-        for mtr in metric_mtrs:
-            self.writer.add_scalar(f'epoch/{mtr.name}', mtr.avg)
-
         results = {
-            'loss': loss_mtr.avg,
-            'metrics': [mtr.avg for mtr in metric_mtrs]
+            'loss': self._average(loss_mtr),
+            'metrics': metrics.result()
         }
 
+        self.writer.add_scalar('epoch/loss', results['loss'])
+        for metric, value in zip(self.metrics, results['metrics']):
+            self.writer.add_scalar(f'epoch/{metric.__name__}', value)
+        for name, value in metrics.per_class().items():
+            self.writer.add_scalar(f'epoch/{name}', value)
+
         if self.do_validation:
             val_results = self._valid_epoch(epoch)
             results = {**results, **val_results}
@@ -85,6 +172,60 @@ class Trainer(TrainerBase):
 
         return results
 
+    def _optimizer_step(self, residues: torch.tensor):
+        """ Updates the parameters with the gradients accumulated since the last step
+        Args:
+            residues: number of residues the gradients were summed over
+        """
+        # distributed gradients are averaged over the processes, and so are the residues
+        if is_distributed():
+            residues = all_reduce(residues.clone().float()) / get_world_size()
+
+        residues = residues.clamp(min=1)
+        for group in self.optimizer.param_groups:
+            for param in group['params']:
+                if param.grad is not None:
+                    param.grad.div_(residues)
+
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+
+    def _log_profile(self, epoch: int, profile: dict):
+        """ Logs the throughput and the time of each phase of the training steps, and
+        writes them to tensorboard and profile.json in the directory of the run
+        Args:
+            epoch: current epoch
+            profile: summary of the step profiler
+        """
+        proteins_per_second = profile['proteins_per_second']
+        log.info(f'Training throughput: {proteins_per_second:.1f} proteins/s, '
+                    f'{profile["residues_per_second"]:.0f} residues/s '
+                    f'({self.precision})')
+        phases = [name[:-3] for name in profile if name.endswith('_ms')]
+        if phases:
+            log.info('Step time: ' + ', '.join(
+                f'{phase} {profile[f"{phase}_ms"]:.1f} ms '
+                f'({profile[f"{phase}_fraction"]:.0%})'
+                for phase in phases))
+
+        for name, value in profile.items():
+            if name not in ('steps', 'seconds'):
+                self.writer.add_scalar(f'profile/{name}', value)
+        self.writer.add_scalar('epoch/proteins_per_second', proteins_per_second)
+
+        if is_main_process():
+            save_profile(self.checkpoint_dir.parent / 'profile.json', epoch, profile)
+
+    def _average(self, meter: AverageMeter) -> float:
+        """ Returns the average of a meter over the processes of a distributed run
+        Args:
+            meter: meter of this process
+        """
+        totals = torch.tensor([float(meter.sum), meter.count], dtype=torch.float64)
+        totals = all_reduce(totals)
+
+        return (totals[0] / totals[1]).item()
 
     def _log_batch(self, epoch: int, batch_idx: int, batch_size: int, len_data: int, loss: float):
         """ Logging of the batches
@@ -131,19 +272,24 @@ class Trainer(TrainerBase):
         self.model.eval()
 
         loss_mtr = AverageMeter('loss')
-        metric_mtrs = [AverageMeter(m.__name__) for m in self.metrics]
+        metrics = MetricTracker(self.metrics, self.metrics_task,
+                                distributed=is_distributed())
+
+        # a distributed process gets no batch if there are fewer batches than processes
+        data = target = output = None
 
         # loss and metrics of validation data 
         with torch.no_grad():
             for batch_idx, (data, target, mask) in enumerate(self.valid_data_loader):
-                data, target = data.to(self.device), target.to(self.device)
-                output = self.model(data, mask)
-                loss = self.loss(output, target)
+                data = data.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
+                with autocast(self.precision, self.device):
+                    output = self.model(data, mask)
+                    loss = self.loss(output, target)
 
                 # update loss
-                loss_mtr.update(loss.item(), data.size(0))
-                for mtr, value in zip(metric_mtrs, self._eval_metrics(output, target)):
-                    mtr.update(value, data.size(0))
+                loss_mtr.update(loss, data.size(0))
+                metrics.update(output, target)
 
         # cleanup
         del data
@@ -152,12 +298,16 @@ class Trainer(TrainerBase):
         torch.cuda.empty_cache()
 
         # write results
+        results = {
+            'val_loss': self._average(loss_mtr),
+            'val_metrics': metrics.result()
+        }
+
         self.writer.set_step(epoch, 'valid')
-        self.writer.add_scalar('loss', loss_mtr.avg)
-        for mtr in metric_mtrs:
-            self.writer.add_scalar(mtr.name, mtr.avg)
+        self.writer.add_scalar('loss', results['val_loss'])
+        for metric, value in zip(self.metrics, results['val_metrics']):
+            self.writer.add_scalar(metric.__name__, value)
+        for name, value in metrics.per_class().items():
+            self.writer.add_scalar(name, value)
 
-        return {
-            'val_loss': loss_mtr.avg,
-            'val_metrics': [mtr.avg for mtr in metric_mtrs]
-        }
+        return results
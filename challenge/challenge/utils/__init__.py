@@ -1,3 +1,32 @@
 from .saving import log_path, trainer_paths
 from .visualization import TensorboardWriter
 from .logger import setup_logger, setup_logging
+from .storage import (
+    open_memmap,
+    read_shape,
+    iter_proteins,
+    read_ids,
+    protein_lengths,
+    is_converted,
+    read_manifest,
+    convert_dataset,
+    ConvertedDataset
+)
+from .sampler import BucketBatchSampler, DistributedSubsetSampler
+from .precision import check_precision, autocast, grad_scaler
+from .checkpoint import CheckpointWriter
+from .profiler import StepProfiler, save_profile
+from .export import export_model, load_exported, is_exported
+from .quantization import quantize, compare_quantized
+from .pipeline import BackgroundIterator, BackgroundWorker
+from .predictions import prediction_writer, PREDICTION_FORMATS
+from .distributed import (
+    init_distributed,
+    is_distributed,
+    get_rank,
+    get_local_rank,
+    get_world_size,
+    is_main_process,
+    all_reduce,
+    broadcast_object
+)
@@ -0,0 +1,123 @@
+import os
+import re
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+import torch
+
+from .logger import setup_logger
+
+
+log = setup_logger(__name__)
+
+
+def snapshot(state):
+    """ Returns a copy of a state on the CPU, so training can keep updating the original
+    Args:
+        state: tensor, or dictionary, list or tuple of states
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+
+    return state
+
+
+class CheckpointWriter:
+    """ Saves checkpoints on a background thread, from a snapshot of the state taken on
+    save. Files are written under a temporary name and renamed once complete,
+    model_best.pth is a hardlink (or a copy) of the checkpoint file it was saved with.
+    """
+
+    def __init__(self, checkpoint_dir: Path, keep_last_k: int = None):
+        """ Constructor
+        Args:
+            checkpoint_dir: directory of the checkpoints
+            keep_last_k: number of checkpoint-epoch files to keep, all if None
+        """
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.keep_last_k = keep_last_k
+        self.error = None
+
+        # one checkpoint waits while the previous one is written, later saves block
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state: dict, epoch: int, save_best: bool = False):
+        """ Queues a checkpoint
+        Args:
+            state: state of the checkpoint
+            epoch: epoch of the checkpoint
+            save_best: also saves the checkpoint as model_best.pth
+        """
+        self._raise()
+        self.queue.put((snapshot(state), epoch, save_best))
+
+    def flush(self):
+        """ Waits until all queued checkpoints are written """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        """ Writes the queued checkpoints and stops the background thread """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        """ Raises the error of a failed write in the training thread """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state: dict, epoch: int, save_best: bool):
+        """ Writes a checkpoint, links it as the best model and removes old ones """
+        filename = self.checkpoint_dir / f'checkpoint-epoch{epoch}.pth'
+        tmp_path = filename.with_suffix('.pth.tmp')
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, filename)
+        log.info(f"Saving checkpoint: {filename} ...")
+
+        if save_best:
+            best_path = self.checkpoint_dir / 'model_best.pth'
+            tmp_path = best_path.with_suffix('.pth.tmp')
+            if tmp_path.exists():
+                tmp_path.unlink()
+            try:
+                os.link(filename, tmp_path)
+            except OSError:
+                shutil.copyfile(filename, tmp_path)
+            os.replace(tmp_path, best_path)
+            log.info(f'Saving current best: {best_path}')
+
+        if self.keep_last_k:
+            self._remove_old()
+
+    def _remove_old(self):
+        """ Removes all checkpoint-epoch files but the last keep_last_k """
+        def epoch(path):
+            return int(re.search(r'checkpoint-epoch(\d+)\.pth$', path.name).group(1))
+
+        checkpoints = self.checkpoint_dir.glob('checkpoint-epoch*.pth')
+        checkpoints = sorted(checkpoints, key=epoch)
+        for path in checkpoints[:-self.keep_last_k]:
+            path.unlink()
@@ -0,0 +1,74 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+BACKEND = 'gloo'
+
+
+def init_distributed(rank: int, world_size: int, local_rank: int, master_addr: str,
+                        master_port: int):
+    """ Joins the process group of a distributed run
+    Args:
+        rank: rank of the process over all nodes
+        world_size: number of processes over all nodes
+        local_rank: rank of the process on its node
+        master_addr: address of the node of rank 0
+        master_port: free port on the node of rank 0
+    """
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+
+    dist.init_process_group(BACKEND, rank=rank, world_size=world_size)
+
+
+def is_distributed() -> bool:
+    """ Returns whether the process is part of a distributed run """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    """ Returns the rank of the process, 0 if not distributed """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_local_rank() -> int:
+    """ Returns the rank of the process on its node, 0 if not distributed """
+    return int(os.environ.get('LOCAL_RANK', 0)) if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    """ Returns the number of processes, 1 if not distributed """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """ Returns whether the process writes checkpoints, logs and evaluations """
+    return get_rank() == 0
+
+
+def all_reduce(tensor: torch.tensor) -> torch.tensor:
+    """ Sums the tensor of all processes in place
+    Args:
+        tensor: tensor of this process
+    """
+    if is_distributed():
+        dist.all_reduce(tensor)
+
+    return tensor
+
+
+def broadcast_object(obj):
+    """ Returns the object of the main process in every process
+    Args:
+        obj: picklable object, only used in the main process
+    """
+    if not is_distributed():
+        return obj
+
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+
+    return objects[0]
@@ -0,0 +1,86 @@
+import json
+import zipfile
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from .logger import setup_logger
+
+
+log = setup_logger(__name__)
+
+# file of the exported archive with the metadata of the model
+METADATA = 'metadata.json'
+
+
+def export_model(model: nn.Module, example: tuple, path: str, metadata: dict = None,
+                    reference: nn.Module = None) -> Path:
+    """ Writes a model as a TorchScript archive with only its weights, which is loaded
+    with load_exported without the classes of the model. The model is scripted, or
+    traced with the example inputs if it cannot be scripted, then frozen for inference
+    Args:
+        model: model to export, in evaluation mode
+        example: example inputs of the forward pass, used to trace and check the model
+        path: file path of the archive
+        metadata: information stored with the model, returned by load_exported
+        reference: model whose outputs the exported model has to match, the model itself
+            if None
+    Returns:
+        path of the archive
+    """
+    model = model.eval()
+    reference = (reference or model).eval()
+
+    with torch.no_grad():
+        try:
+            scripted = torch.jit.script(model)
+        except Exception as error:
+            log.warning(f'Scripting failed, tracing the model instead: {error}')
+            scripted = torch.jit.trace(model, example)
+
+        # inlines the weights as constants and folds the operations that only depend on
+        # them
+        scripted = torch.jit.freeze(scripted)
+
+        expected = reference(*example)
+        exported = scripted(*example)
+        for output, expected_output in zip(exported, expected):
+            if not torch.allclose(output, expected_output, atol=1e-5):
+                raise RuntimeError('The exported model does not match the outputs of '
+                                    'the model')
+
+    path = Path(path)
+    torch.jit.save(scripted, str(path),
+                    _extra_files={METADATA: json.dumps(metadata or {})})
+
+    return path
+
+
+def load_exported(path: str, device: torch.device = torch.device('cpu')) -> (
+        torch.jit.ScriptModule, dict):
+    """ Loads a model written by export_model
+    Args:
+        path: file path of the archive
+        device: device to load the model on
+    Returns:
+        the model and its metadata
+    """
+    extra_files = {METADATA: ''}
+    model = torch.jit.load(str(path), map_location=device, _extra_files=extra_files)
+
+    return model, json.loads(extra_files[METADATA] or '{}')
+
+
+def is_exported(path: str) -> bool:
+    """ Returns whether the file is a model written by export_model rather than a
+    checkpoint
+    Args:
+        path: file path of the model
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+
+    # TorchScript archives contain the code of the model, checkpoints only pickled data
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('constants.pkl') for name in archive.namelist())
@@ -0,0 +1,115 @@
+import queue
+import threading
+
+
+# marks the end of the items of a queue
+_END = object()
+
+
+class BackgroundIterator:
+    """ Iterates over an iterable on a background thread, at most maxsize items ahead of
+    the consumer. Errors of the iterable are raised in the consumer.
+    """
+
+    def __init__(self, iterable, maxsize: int = 2):
+        """ Constructor
+        Args:
+            iterable: items to produce, eg. batches read from disk
+            maxsize: items produced in advance, which bounds their memory
+        """
+        self.iterable = iterable
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        """ Queues an item, returns False if the consumer stopped meanwhile """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _run(self):
+        """ Produces the items until the end of the iterable or until stopped """
+        try:
+            for item in self.iterable:
+                if not self._put(item):
+                    return
+        except Exception as error:
+            self._put(error)
+            return
+
+        self._put(_END)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+
+    def close(self):
+        """ Stops the background thread, also before the end of the iterable """
+        self.stopped.set()
+        self.thread.join()
+
+
+class BackgroundWorker:
+    """ Calls a function with each submitted item on a background thread, with at most
+    maxsize items waiting. Errors of the function are raised on the next submit or on
+    close.
+    """
+
+    def __init__(self, function: callable, maxsize: int = 2):
+        """ Constructor
+        Args:
+            function: called with every item in the order they are submitted
+            maxsize: items waiting for the function, submit blocks beyond that
+        """
+        self.function = function
+        self.error = None
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _raise(self):
+        """ Raises the error of the background thread, if it failed """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        """ Processes the items until the end is queued, the items after an error are
+        dropped
+        """
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if self.error is None:
+                try:
+                    self.function(item)
+                except Exception as error:
+                    self.error = error
+
+    def submit(self, item):
+        """ Queues an item for the function
+        Args:
+            item: argument of the function
+        """
+        self._raise()
+        self.queue.put(item)
+
+    def close(self):
+        """ Waits for the queued items to be processed """
+        self.queue.put(_END)
+        self.thread.join()
+        self._raise()
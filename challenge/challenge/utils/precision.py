@@ -0,0 +1,58 @@
+import contextlib
+
+import torch
+
+
+# precisions of the forward pass and the loss, float32 disables autocast
+PRECISIONS = {
+    'float32': None,
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16
+}
+
+
+def check_precision(precision: str, device: torch.device):
+    """ Raises an error if the precision is not supported on the device
+    Args:
+        precision: 'float32', 'bfloat16' or 'float16'
+        device: device of the model
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision "{precision}", '
+                            f'expected one of {list(PRECISIONS)}')
+    if precision == 'float16' and device.type != 'cuda':
+        raise ValueError('The float16 precision requires a GPU, use bfloat16 on CPU')
+    if precision != 'float32' and not hasattr(torch, 'autocast'):
+        # before torch 1.10 autocast only exists for float16 on GPU
+        if precision != 'float16':
+            raise ValueError(f'The {precision} precision requires torch >= 1.10')
+
+
+def autocast(precision: str, device: torch.device):
+    """ Returns the context that runs the forward pass and the loss in the precision
+    Args:
+        precision: 'float32', 'bfloat16' or 'float16'
+        device: device of the model
+    """
+    check_precision(precision, device)
+
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=PRECISIONS[precision])
+
+    return torch.cuda.amp.autocast()
+
+
+def grad_scaler(precision: str):
+    """ Returns the gradient scaler of the precision. Gradients are only scaled for
+    float16, whose range is too small for them, otherwise the scaler calls the optimizer
+    directly
+    Args:
+        precision: 'float32', 'bfloat16' or 'float16'
+    """
+    # newer versions of torch moved the gradient scaler to torch.amp
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=precision == 'float16')
+
+    return torch.cuda.amp.GradScaler(enabled=precision == 'float16')
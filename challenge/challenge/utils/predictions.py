@@ -0,0 +1,301 @@
+import os
+import shutil
+import zipfile
+import operator
+import itertools
+from pathlib import Path
+
+import numpy as np
+
+
+class PredictionWriter:
+    """ Base class of the prediction writers, which write the predictions batch by batch
+    as they are predicted. The predicted classes are decoded with lookup tables of the
+    class letters
+    """
+
+    # whether the format stores the probabilities of the classes
+    probabilities = False
+
+    def __init__(self, path: str, classes: dict, probabilities: bool = False):
+        """ Constructor
+        Args:
+            path: file path of the predictions
+            classes: name of each task and the letters of its classes, in the order of
+                the model outputs
+            probabilities: whether the probabilities of the classes are written
+        """
+        self.path = Path(path)
+        self.classes = classes
+        self.write_probabilities = probabilities
+        self.proteins = 0
+        self.residues = 0
+
+    def write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list = None):
+        """ Appends the proteins of a batch
+        Args:
+            ids: identifier of each protein
+            lengths: number of predicted residues of each protein
+            predictions: predicted class indices of each task for the residues of the
+                batch, protein after protein
+            probabilities: (residues, classes) probabilities of each task, if stored
+        """
+        lengths = np.asarray(lengths)
+        predictions = [np.asarray(indices) for indices in predictions]
+        if probabilities is not None:
+            probabilities = [np.asarray(values) for values in probabilities]
+
+        self._write(list(ids), lengths, predictions, probabilities)
+        self.proteins += len(lengths)
+        self.residues += int(lengths.sum())
+
+    def _write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list):
+        """ Writes a batch, see write """
+        raise NotImplementedError
+
+    def _write_empty(self):
+        """ Writes a batch without proteins, so every column exists for an empty
+        input
+        """
+        probabilities = None
+        if self.write_probabilities:
+            probabilities = [np.zeros((0, len(letters)), dtype=np.float32)
+                                for letters in self.classes.values()]
+
+        self._write([], np.zeros(0, dtype=np.int64),
+                    [np.zeros(0, dtype=np.int8) for _ in self.classes], probabilities)
+
+    def close(self):
+        """ Completes the file """
+        pass
+
+    def abort(self):
+        """ Removes the partial file after a failure, instead of completing it """
+        if self.path.exists():
+            os.remove(self.path)
+
+
+class CSVPredictionWriter(PredictionWriter):
+    """ Writes a row per residue with the letter of the class of each task, in the
+    format of DataFrame.to_csv with the index of the residue as row label
+    """
+
+    def __init__(self, path: str, classes: dict, probabilities: bool = False):
+        super().__init__(path, classes, probabilities)
+        self.handle = open(self.path, 'w')
+        self.handle.write(',' + ','.join(classes) + '\n')
+
+        # the end of the row of every combination of classes, indexed by the combined
+        # class
+        self.dims = [len(letters) for letters in classes.values()]
+        combinations = itertools.product(*classes.values())
+        self.rows = np.array([''.join(f',{letter}' for letter in combination) + '\n'
+                                for combination in combinations], dtype=object)
+
+    def _write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list):
+        rows = self.rows[np.ravel_multi_index(predictions, self.dims)].tolist()
+        index = map(str, range(self.residues, self.residues + len(rows)))
+
+        self.handle.write(''.join(map(operator.add, index, rows)))
+
+    def close(self):
+        self.handle.close()
+
+    def abort(self):
+        self.handle.close()
+        super().abort()
+
+
+class FASTAPredictionWriter(PredictionWriter):
+    """ Writes a FASTA record per protein and task, the header is the identifier of the
+    protein and the task and the sequence the letters of the predicted classes
+    """
+
+    def __init__(self, path: str, classes: dict, probabilities: bool = False):
+        super().__init__(path, classes, probabilities)
+        self.handle = open(self.path, 'w')
+        self.tables = [np.frombuffer(letters.encode('ascii'), dtype='S1')
+                        for letters in classes.values()]
+
+    def _write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list):
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        sequences = [table[indices].tobytes().decode('ascii')
+                        for table, indices in zip(self.tables, predictions)]
+
+        records = []
+        for protein, start, stop in zip(ids, offsets[:-1], offsets[1:]):
+            for task, sequence in zip(self.classes, sequences):
+                records.append(f'>{protein} {task}\n{sequence[start:stop]}\n')
+        self.handle.write(''.join(records))
+
+    def close(self):
+        self.handle.close()
+
+    def abort(self):
+        self.handle.close()
+        super().abort()
+
+
+class NPZPredictionWriter(PredictionWriter):
+    """ Writes an uncompressed ``.npz`` archive with the identifier and the number of
+    predicted residues of each protein (``ids`` and ``lengths``), the class indices of
+    the residues of each task (eg. ``q8``), protein after protein, the letters of the
+    classes (eg. ``q8_classes``) and optionally their probabilities
+    (eg. ``q8_probabilities``). The columns are appended to temporary files and copied
+    into the archive when it is closed, every column is written also without proteins.
+    """
+
+    probabilities = True
+
+    def __init__(self, path: str, classes: dict, probabilities: bool = False):
+        super().__init__(path, classes, probabilities)
+        self.ids = []
+        self.columns = {}
+
+    def _append(self, name: str, values: np.ndarray):
+        """ Appends values to the temporary file of a column """
+        if name not in self.columns:
+            tmp_path = self.path.with_name(f'{self.path.name}.{name}.tmp')
+            self.columns[name] = (tmp_path, open(tmp_path, 'wb'), values.dtype,
+                                    values.shape[1:], [0])
+
+        _, handle, dtype, shape, rows = self.columns[name]
+        handle.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        rows[0] += len(values)
+
+    def _write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list):
+        self.ids.extend(ids)
+        self._append('lengths', lengths.astype(np.int64))
+        for i, task in enumerate(self.classes):
+            self._append(task, predictions[i].astype(np.int8))
+            if probabilities is not None:
+                self._append(f'{task}_probabilities',
+                                probabilities[i].astype(np.float32))
+
+    def close(self):
+        # the columns of an input without proteins are empty
+        if 'lengths' not in self.columns:
+            self._write_empty()
+
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED,
+                                allowZip64=True) as archive:
+            with archive.open('ids.npy', 'w') as fh:
+                np.save(fh, np.array(self.ids, dtype=str))
+            for task, letters in self.classes.items():
+                with archive.open(f'{task}_classes.npy', 'w') as fh:
+                    np.save(fh, np.array(list(letters)))
+
+            for name, (tmp_path, handle, dtype, shape, rows) in self.columns.items():
+                handle.close()
+                header = {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (rows[0], *shape)
+                }
+                with archive.open(f'{name}.npy', 'w', force_zip64=True) as fh, \
+                        open(tmp_path, 'rb') as src:
+                    np.lib.format.write_array_header_2_0(fh, header)
+                    shutil.copyfileobj(src, fh)
+                os.remove(tmp_path)
+
+    def abort(self):
+        for tmp_path, handle, *_ in self.columns.values():
+            handle.close()
+            if tmp_path.exists():
+                os.remove(tmp_path)
+        super().abort()
+
+
+class ParquetPredictionWriter(PredictionWriter):
+    """ Writes a Parquet table with a row per residue: the identifier of the protein,
+    the position of the residue, the class of each task (eg. ``q8``) and optionally the
+    probability of each class (eg. ``q8_G``). Every batch is a row group. Requires
+    pyarrow.
+    """
+
+    probabilities = True
+
+    def __init__(self, path: str, classes: dict, probabilities: bool = False):
+        super().__init__(path, classes, probabilities)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('The parquet format requires pyarrow, install it with '
+                                'pip install pyarrow')
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.dictionaries = [pyarrow.array(list(letters))
+                                for letters in classes.values()]
+        self.writer = None
+
+    def _write(self, ids: list, lengths: np.ndarray, predictions: list,
+                probabilities: list):
+        pa = self.pa
+        offsets = np.cumsum(lengths) - lengths
+
+        columns = {
+            'protein': pa.DictionaryArray.from_arrays(
+                np.repeat(np.arange(len(ids), dtype=np.int32), lengths),
+                pa.array(ids, pa.string())),
+            'position': pa.array(np.arange(lengths.sum()) - np.repeat(offsets, lengths))
+        }
+        for i, (task, letters) in enumerate(self.classes.items()):
+            columns[task] = pa.DictionaryArray.from_arrays(
+                predictions[i].astype(np.int8), self.dictionaries[i])
+            if probabilities is not None:
+                for j, letter in enumerate(letters):
+                    values = probabilities[i][:, j].astype(np.float32)
+                    columns[f'{task}_{letter}'] = pa.array(values)
+
+        table = pa.table(columns)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(str(self.path), table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        # an input without proteins is written as a table without rows
+        if self.writer is None:
+            self._write_empty()
+        self.writer.close()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        super().abort()
+
+
+PREDICTION_FORMATS = {
+    'csv': CSVPredictionWriter,
+    'fasta': FASTAPredictionWriter,
+    'npz': NPZPredictionWriter,
+    'parquet': ParquetPredictionWriter
+}
+
+
+def prediction_writer(output_format: str, path: str, classes: dict,
+                        probabilities: bool = False) -> PredictionWriter:
+    """ Returns the writer of a prediction format
+    Args:
+        output_format: 'csv', 'fasta', 'npz' or 'parquet'
+        path: file path of the predictions
+        classes: name of each task and the letters of its classes, in the order of the
+            model outputs
+        probabilities: whether the probabilities of the classes are written
+    """
+    if output_format not in PREDICTION_FORMATS:
+        raise ValueError(f'Unknown format "{output_format}", '
+                            f'expected one of {list(PREDICTION_FORMATS)}')
+
+    writer = PREDICTION_FORMATS[output_format]
+    if probabilities and not writer.probabilities:
+        raise ValueError(f'The {output_format} format does not store probabilities, '
+                            f'use npz or parquet')
+
+    return writer(path, classes, probabilities)
@@ -0,0 +1,178 @@
+import json
+import time
+import contextlib
+from pathlib import Path
+
+import torch
+
+from .logger import setup_logger
+from .distributed import all_reduce
+
+
+log = setup_logger(__name__)
+
+
+# phases of a training step, in the order they run
+PHASES = ('data', 'h2d', 'forward', 'backward', 'optimizer', 'metrics')
+
+
+class StepProfiler:
+    """ Times the phases of the training steps of an epoch and counts their proteins and
+    residues. Timing a phase synchronizes the GPU, so phases are only timed when
+    enabled, the throughput is always measured. Optionally traces a window of steps with
+    torch.profiler.
+    """
+
+    def __init__(self, device: torch.device, enabled: bool = False,
+                    trace_steps: list = None, trace_dir: Path = None):
+        """ Constructor
+        Args:
+            device: device of the model
+            enabled: times the phases of each step
+            trace_steps: [first, last] steps of the epoch traced with torch.profiler,
+                both included, none if None
+            trace_dir: directory of the torch.profiler traces, viewed with tensorboard
+        """
+        if trace_steps is not None and (
+                len(trace_steps) != 2 or not 0 <= trace_steps[0] <= trace_steps[1]):
+            raise ValueError(f'Expected [first, last] training steps to trace with '
+                                f'0 <= first <= last, got {trace_steps}')
+
+        # torch.profiler was added in PyTorch 1.8.1
+        self.profiler = None
+        if trace_steps is not None:
+            try:
+                from torch import profiler
+            except ImportError:
+                raise ImportError('profile_trace requires torch.profiler of PyTorch '
+                                    '>= 1.8.1, upgrade PyTorch or set '
+                                    'profile_trace: null')
+            self.profiler = profiler
+
+        self.device = device
+        self.enabled = enabled
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.trace = None
+        self.reset()
+
+    def reset(self):
+        """ Starts a new epoch """
+        self.seconds = dict.fromkeys(PHASES, 0.)
+        self.steps = 0
+        self.proteins = 0
+        self.residues = 0
+        self.start = self.last = time.perf_counter()
+
+    def start_trace(self):
+        """ Traces the steps of trace_steps of this epoch with torch.profiler """
+        if not self.trace_steps:
+            return
+
+        first, last = self.trace_steps
+        activities = [self.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(self.profiler.ProfilerActivity.CUDA)
+
+        self.trace = self.profiler.profile(
+            activities=activities,
+            schedule=self.profiler.schedule(
+                wait=max(first - 1, 0), warmup=min(first, 1), active=last - first + 1,
+                repeat=1),
+            on_trace_ready=self.profiler.tensorboard_trace_handler(str(self.trace_dir)),
+            record_shapes=True)
+        self.trace.__enter__()
+        log.info(f'Tracing training steps {first} to {last} into {self.trace_dir}')
+
+    def stop_trace(self):
+        """ Stops tracing, the trace is written once its window is complete """
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+
+    def _now(self) -> float:
+        """ Returns the time once the queued work of the device is done """
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+        return time.perf_counter()
+
+    def mark(self, phase: str):
+        """ Adds the time since the previous phase to a phase, eg. waiting for the batch
+        Args:
+            phase: name of the phase
+        """
+        if self.enabled:
+            now = self._now()
+            self.seconds[phase] += now - self.last
+            self.last = now
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        """ Times the code run in the context as a phase, and labels it in the trace
+        while tracing
+        Args:
+            phase: name of the phase
+        """
+        label = contextlib.nullcontext()
+        if self.trace is not None:
+            label = self.profiler.record_function(phase)
+
+        if not self.enabled:
+            with label:
+                yield
+            return
+
+        start = self._now()
+        with label:
+            yield
+        self.last = self._now()
+        self.seconds[phase] += self.last - start
+
+    def step(self, proteins: int, residues: torch.tensor):
+        """ Ends a training step
+        Args:
+            proteins: number of proteins of the batch
+            residues: number of residues of the batch, counted without waiting for the
+                device
+        """
+        self.steps += 1
+        self.proteins += proteins
+        self.residues = self.residues + residues
+        if self.trace is not None:
+            self.trace.step()
+
+    def summary(self) -> dict:
+        """ Returns the throughput of the epoch over all processes of a distributed run
+        and the time of each phase per step of this process
+        """
+        seconds = time.perf_counter() - self.start
+        counts = [self.proteins, float(self.residues)]
+        counts = all_reduce(torch.tensor(counts, dtype=torch.float64))
+        proteins, residues = counts.tolist()
+
+        summary = {
+            'steps': self.steps,
+            'seconds': seconds,
+            'proteins_per_second': proteins / seconds,
+            'residues_per_second': residues / seconds
+        }
+        if self.enabled:
+            for phase, phase_seconds in self.seconds.items():
+                summary[f'{phase}_ms'] = 1000 * phase_seconds / max(self.steps, 1)
+                summary[f'{phase}_fraction'] = phase_seconds / seconds
+
+        return summary
+
+
+def save_profile(path: Path, epoch: int, summary: dict):
+    """ Adds the profile of an epoch to a JSON file of all epochs of the run
+    Args:
+        path: path of the JSON file
+        epoch: epoch of the profile
+        summary: profile of the epoch
+    """
+    path = Path(path)
+    profiles = json.loads(path.read_text()) if path.exists() else []
+    profiles.append({'epoch': epoch, **summary})
+    path.write_text(json.dumps(profiles, indent=2))
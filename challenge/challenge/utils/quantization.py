@@ -0,0 +1,77 @@
+import io
+import time
+
+import torch
+import torch.nn as nn
+
+
+# quantizations of the Linear layers for CPU inference
+QUANTIZATIONS = {
+    'int8': torch.qint8
+}
+
+
+def quantize(model: nn.Module, quantization: str) -> nn.Module:
+    """ Returns a copy of the model with dynamically quantized Linear layers. Their
+    weights are stored in int8 and the activations are quantized per batch, so no
+    calibration is needed
+    Args:
+        model: model in evaluation mode
+        quantization: 'int8'
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'Unknown quantization "{quantization}", '
+                            f'expected one of {list(QUANTIZATIONS)}')
+    if isinstance(model, torch.jit.ScriptModule):
+        raise ValueError('Exported models cannot be quantized, export the model with '
+                            '--quantize')
+
+    # newer versions of torch moved quantization to torch.ao
+    module = getattr(torch, 'ao', torch).quantization
+    return module.quantize_dynamic(model, {nn.Linear},
+                                    dtype=QUANTIZATIONS[quantization])
+
+
+def model_size(model: nn.Module) -> int:
+    """ Returns the bytes of the serialized weights of the model """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.getbuffer().nbytes
+
+
+def compare_quantized(model: nn.Module, quantized: nn.Module, batches: list) -> dict:
+    """ Returns the agreement of the classes predicted by the quantized and the float
+    model for each output, and the time both need for the batches
+    Args:
+        model: float model
+        quantized: quantized model
+        batches: (X, mask) batches
+    """
+    seconds, predictions = {}, {}
+    with torch.no_grad():
+        for name, _model in (('float', model), ('quantized', quantized)):
+            # warmup, the first batch of a model allocates its buffers
+            _model(*batches[0])
+
+            start = time.perf_counter()
+            outputs = [_model(X, mask) for X, mask in batches]
+            seconds[name] = time.perf_counter() - start
+
+            # classes of the residues of the proteins of every output
+            predictions[name] = [
+                torch.cat([torch.argmax(output[i], dim=2)[mask == 1]
+                            for output, (_, mask) in zip(outputs, batches)])
+                for i in range(len(outputs[0]))
+            ]
+
+    agreement = [(a == b).float().mean().item()
+                    for a, b in zip(predictions['float'], predictions['quantized'])]
+
+    return {
+        'agreement': agreement,
+        'float_seconds': seconds['float'],
+        'quantized_seconds': seconds['quantized'],
+        'float_bytes': model_size(model),
+        'quantized_bytes': model_size(quantized)
+    }
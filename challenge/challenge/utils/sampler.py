@@ -0,0 +1,139 @@
+import math
+
+import numpy as np
+import torch
+
+from torch.utils.data.sampler import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """ Batches proteins of similar length, each up to a budget of residues """
+
+    def __init__(self, indices: np.ndarray, lengths: np.ndarray, max_residues: int,
+                    shuffle: bool = True, num_replicas: int = 1, rank: int = 0,
+                    seed: int = 0, pad: bool = True):
+        """ Constructor
+        Args:
+            indices: indices of the proteins to sample
+            lengths: number of residues of every protein in the dataset
+            max_residues: maximum of padded residues in a batch, ie. batch size times
+                its longest protein. Longer proteins are put in a batch of their own
+            shuffle: shuffles proteins of the same length and the order of the batches
+            num_replicas: number of processes of a distributed run, each gets every
+                num_replicas-th batch of the same order
+            rank: rank of the process
+            seed: seed of the order shared by the processes, together with the epoch
+            pad: repeats batches so every process gets the same number of batches
+        """
+        self.indices = np.asarray(indices)
+        self.lengths = np.asarray(lengths)[self.indices]
+        self.max_residues = max_residues
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+
+        # batches only depend on the sorted lengths, so their sizes never change
+        self.batch_sizes = self._batch_sizes(np.sort(self.lengths))
+
+    def _batch_sizes(self, lengths: np.ndarray) -> list:
+        """ Returns the size of each batch of the sorted lengths
+        Args:
+            lengths: lengths in ascending order
+        """
+        batch_sizes = [0]
+        for length in lengths:
+            # lengths are sorted, so the current protein is the longest of the batch
+            if batch_sizes[-1] and (batch_sizes[-1] + 1) * length > self.max_residues:
+                batch_sizes.append(0)
+            batch_sizes[-1] += 1
+
+        return batch_sizes if batch_sizes[-1] else []
+
+    @property
+    def batch_size(self) -> int:
+        """ Returns the average number of proteins in a batch """
+        return max(1, round(len(self.indices) / max(1, len(self.batch_sizes))))
+
+    def set_epoch(self, epoch: int):
+        """ Sets the epoch the order of a distributed run is derived from """
+        self.epoch = epoch
+
+    def __iter__(self):
+        # the processes of a distributed run have to agree on the order
+        generator = None
+        if self.num_replicas > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+
+        if self.shuffle:
+            order = torch.randperm(len(self.indices), generator=generator).numpy()
+            order = order[np.argsort(self.lengths[order], kind='stable')]
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = np.split(self.indices[order], np.cumsum(self.batch_sizes)[:-1])
+
+        if self.shuffle:
+            batch_order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in batch_order]
+
+        if self.num_replicas > 1:
+            if self.pad and batches:
+                batches = (batches * self.num_replicas)[:len(self) * self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.pad:
+            return math.ceil(len(self.batch_sizes) / self.num_replicas)
+
+        return len(range(self.rank, len(self.batch_sizes), self.num_replicas))
+
+
+class DistributedSubsetSampler(Sampler):
+    """ Samples the part of a process of a distributed run from a subset of the data """
+
+    def __init__(self, indices: np.ndarray, num_replicas: int, rank: int,
+                    shuffle: bool = True, seed: int = 0, pad: bool = True):
+        """ Constructor
+        Args:
+            indices: indices of the proteins to sample
+            num_replicas: number of processes, each gets every num_replicas-th index of
+                the same order
+            rank: rank of the process
+            shuffle: shuffles the indices every epoch
+            seed: seed of the order shared by the processes, together with the epoch
+            pad: repeats indices so every process gets the same number of them
+        """
+        self.indices = np.asarray(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """ Sets the epoch the order is derived from """
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+
+        if self.pad and len(indices):
+            indices = np.resize(indices, len(self) * self.num_replicas)
+
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        if self.pad:
+            return math.ceil(len(self.indices) / self.num_replicas)
+
+        return len(range(self.rank, len(self.indices), self.num_replicas))
@@ -0,0 +1,585 @@
+import os
+import json
+import shutil
+import hashlib
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .logger import setup_logger
+from .saving import ensure_exists
+
+
+log = setup_logger(__name__)
+
+DATA_KEY = 'data'
+
+# optional array of the identifiers of the proteins in ``.npz`` datasets
+IDS_KEY = 'ids'
+
+# bytes streamed at a time when copying or iterating archives
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# channels 0-19 are the one-hot encoding, 20-1299 the ESM1b embedding, then the labels
+N_ENCODING = 20
+N_FEATURES = 1300
+
+# label columns: 0 is the mask, 1-8 the one-hot Q8 class
+N_Q8 = 8
+Q8_TO_Q3 = np.array([0, 0, 0, 1, 1, 2, 2, 2])
+
+# optimized dataset format written by convert_dataset
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+CONVERT_DTYPES = {
+    'float32': np.float32,
+    'float16': np.float16,
+    # numpy has no bfloat16, its bits are stored as uint16
+    'bfloat16': np.uint16
+}
+
+
+def memmap_path(path: str) -> Path:
+    """ Returns the path of the uncompressed copy of an ``.npz`` dataset. """
+    return Path(path).with_suffix('.npy')
+
+
+def extract_npz(path: str, key: str = DATA_KEY) -> Path:
+    """ Extracts an array of an ``.npz`` archive to an uncompressed ``.npy`` file next
+    to it. The archive member is streamed to disk, so it is never held in memory. An
+    existing copy is reused as long as it is newer than the archive.
+    Args:
+        path: file path of the ``.npz`` archive
+        key: name of the array in the archive
+    Returns:
+        path of the ``.npy`` file
+    """
+    path = Path(path)
+    target = memmap_path(path)
+
+    if target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+        return target
+
+    log.info(f'Extracting "{key}" from {path} to {target}')
+    tmp_path = target.with_name(target.name + '.tmp')
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(f'{key}.npy') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=CHUNK_BYTES)
+
+    # renamed once the copy is complete, so an interrupted run leaves no partial file
+    os.replace(tmp_path, target)
+    return target
+
+
+def open_memmap(path: str) -> np.memmap:
+    """ Opens the data array of a dataset as a read-only memory map
+    Args:
+        path: file path for the dataset, either ``.npz`` or ``.npy``
+    Returns:
+        memory map of the (proteins, residues, channels) data array
+    """
+    path = Path(path)
+    if path.suffix == '.npz':
+        path = extract_npz(path)
+
+    return np.load(path, mmap_mode='r')
+
+
+def _read_header(fh) -> (tuple, np.dtype, bool):
+    """ Reads the header of a ``.npy`` stream and leaves it at the start of the data
+    Args:
+        fh: binary file handle positioned at the start of the ``.npy`` file
+    Returns:
+        shape, dtype and whether the array is in fortran order
+    """
+    version = np.lib.format.read_magic(fh)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+
+    return shape, dtype, fortran_order
+
+
+def read_shape(path: str, key: str = DATA_KEY) -> (tuple, np.dtype):
+    """ Returns the shape and dtype of the data array without reading it
+    Args:
+        path: file path for the dataset, either ``.npz`` or ``.npy``
+        key: name of the array in an ``.npz`` archive
+    """
+    path = Path(path)
+    if path.suffix == '.npz':
+        with zipfile.ZipFile(path) as archive, archive.open(f'{key}.npy') as fh:
+            shape, dtype, _ = _read_header(fh)
+    else:
+        with open(path, 'rb') as fh:
+            shape, dtype, _ = _read_header(fh)
+
+    return shape, dtype
+
+
+def iter_proteins(path: str, key: str = DATA_KEY) -> (int, np.ndarray):
+    """ Iterates over the data array in chunks of proteins, without loading it at once.
+    ``.npz`` archives are decompressed as a stream.
+    Args:
+        path: file path for the dataset, either ``.npz`` or ``.npy``
+        key: name of the array in an ``.npz`` archive
+    Returns:
+        index of the first protein and the (proteins, residues, channels) chunk
+    """
+    path = Path(path)
+    if path.suffix != '.npz':
+        data = np.load(path, mmap_mode='r')
+        step = max(1, CHUNK_BYTES // max(1, data[:1].nbytes))
+        for start in range(0, len(data), step):
+            yield start, np.asarray(data[start:start + step])
+        return
+
+    with zipfile.ZipFile(path) as archive, archive.open(f'{key}.npy') as fh:
+        shape, dtype, fortran_order = _read_header(fh)
+
+        if fortran_order or not shape:
+            yield 0, np.load(path)[key]
+            return
+
+        row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        step = max(1, CHUNK_BYTES // max(1, row_bytes))
+        for start in range(0, shape[0], step):
+            count = min(step, shape[0] - start)
+            buffer = fh.read(count * row_bytes)
+            yield start, np.frombuffer(buffer, dtype=dtype).reshape((count, *shape[1:]))
+
+
+def read_ids(path: str, key: str = IDS_KEY) -> np.ndarray:
+    """ Returns the identifiers of the proteins of an ``.npz`` dataset, None if it has
+    none
+    Args:
+        path: file path for the dataset
+        key: name of the identifiers in the archive
+    """
+    path = Path(path)
+    if path.suffix != '.npz':
+        return None
+
+    with np.load(path) as archive:
+        return archive[key].astype(str) if key in archive.files else None
+
+
+def protein_lengths(mask: np.ndarray) -> np.ndarray:
+    """ Returns the number of residues of each protein, up to its last unmasked residue
+    Args:
+        mask: (proteins, residues) array, zero for padding
+    """
+    nonzero = np.asarray(mask) != 0
+    last = nonzero.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+
+    return np.where(nonzero.any(axis=1), last, 0).astype(np.int64)
+
+
+def file_hash(path: str) -> str:
+    """ Returns the sha256 hex digest of a file
+    Args:
+        path: path of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(CHUNK_BYTES), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def is_converted(path: str) -> bool:
+    """ Returns whether the path is a dataset written by convert_dataset """
+    return (Path(path) / MANIFEST).is_file()
+
+
+def read_manifest(path: str) -> dict:
+    """ Returns the manifest of a dataset written by convert_dataset
+    Args:
+        path: directory of the converted dataset
+    """
+    with open(Path(path) / MANIFEST) as fh:
+        manifest = json.load(fh)
+
+    if manifest['version'] != FORMAT_VERSION:
+        raise ValueError(f'Unsupported dataset version {manifest["version"]} of '
+                            f'{path}, convert it again')
+
+    return manifest
+
+
+def split_channels(channels: slice) -> (slice, slice):
+    """ Returns the channels of the encoding and of the embedding within their blocks
+    Args:
+        channels: contiguous feature channels
+    """
+    channels = range(N_FEATURES)[channels]
+    if channels.step != 1:
+        raise ValueError('Channels must be contiguous')
+
+    encoding = slice(min(channels.start, N_ENCODING), min(channels.stop, N_ENCODING))
+    embedding = slice(max(channels.start, N_ENCODING) - N_ENCODING,
+                        max(channels.stop, N_ENCODING) - N_ENCODING)
+
+    return encoding, embedding
+
+
+def encode_residues(encoding: np.ndarray) -> np.ndarray:
+    """ Returns the amino acid index of one-hot residues, N_ENCODING for empty rows
+    Args:
+        encoding: (..., N_ENCODING) one-hot encoding
+    """
+    if ((encoding != 0) & (encoding != 1)).any() or (encoding.sum(axis=-1) > 1).any():
+        raise ValueError('The encoding channels are not one-hot encoded')
+
+    residues = np.where(encoding.any(axis=-1), encoding.argmax(axis=-1), N_ENCODING)
+    return residues.astype(np.uint8)
+
+
+def decode_residues(residues: torch.tensor,
+                        encoding: slice = slice(0, N_ENCODING)) -> torch.tensor:
+    """ Returns the one-hot encoding of amino acid indices, empty for N_ENCODING
+    Args:
+        residues: amino acid index of each residue
+        encoding: channels of the encoding to return
+    """
+    return F.one_hot(residues.long(), N_ENCODING + 1)[..., encoding]
+
+
+def encode_labels(labels: np.ndarray) -> np.ndarray:
+    """ Returns the mask, Q8 and Q3 class of each residue, -1 for unlabelled residues
+    Args:
+        labels: (..., label channels) labels with the mask and one-hot Q8 class
+    """
+    q8_onehot = labels[..., 1:N_Q8 + 1]
+    labelled = q8_onehot.any(axis=-1)
+    q8 = q8_onehot.argmax(axis=-1)
+
+    return np.stack([
+        labels[..., 0] != 0,
+        np.where(labelled, q8, -1),
+        np.where(labelled, Q8_TO_Q3[q8], -1)
+    ], axis=-1).astype(np.int8)
+
+
+def decode_labels(labels: torch.tensor, extra: torch.tensor = None) -> torch.tensor:
+    """ Returns float labels in the layout of the dataset files from encoded labels
+    Args:
+        labels: (residues, 3) mask, Q8 and Q3 class of each residue
+        extra: (residues, channels) remaining label channels
+    """
+    q8_onehot = F.one_hot(labels[:, 1].long() + 1, N_Q8 + 1)[:, 1:]
+    columns = [labels[:, :1].float(), q8_onehot.float()]
+    if extra is not None:
+        columns.append(extra.float())
+
+    return torch.cat(columns, dim=1)
+
+
+def _features_to_storage(features: np.ndarray, dtype: str) -> np.ndarray:
+    """ Converts float features to the array stored on disk for a dtype """
+    if dtype == 'bfloat16':
+        bits = torch.from_numpy(np.ascontiguousarray(features, dtype=np.float32))
+        return bits.to(torch.bfloat16).view(torch.int16).numpy().view(np.uint16)
+
+    return features.astype(CONVERT_DTYPES[dtype])
+
+
+def _features_from_storage(features: np.ndarray, dtype: str) -> torch.tensor:
+    """ Returns the tensor of features read from disk for a dtype """
+    features = np.array(features)
+    if dtype == 'bfloat16':
+        return torch.from_numpy(features.view(np.int16)).view(torch.bfloat16)
+
+    return torch.from_numpy(features)
+
+
+class _ShardWriter:
+    """ Writes packed proteins into shards of a converted dataset """
+
+    def __init__(self, output: Path, dtype: str, shard_size: int):
+        self.output = output
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.shards = []
+        self._reset()
+
+    def _reset(self):
+        self.blocks = {'residues': [], 'embedding': [], 'labels': [], 'extra': []}
+        self.lengths = []
+        self.n_proteins = 0
+
+    def add(self, chunk: np.ndarray):
+        """ Adds a (proteins, residues, channels) chunk, starting shards when full """
+        start = 0
+        while start < len(chunk):
+            count = min(self.shard_size - self.n_proteins, len(chunk) - start)
+            self._pack(chunk[start:start + count])
+            start += count
+
+            if self.n_proteins == self.shard_size:
+                self.flush()
+
+    def _pack(self, chunk: np.ndarray):
+        """ Adds the residues of each protein of the chunk to the current shard """
+        lengths = protein_lengths(chunk[:, :, N_FEATURES])
+        rows = np.arange(chunk.shape[1]) < lengths[:, None]
+
+        self.blocks['residues'].append(encode_residues(chunk[:, :, :N_ENCODING][rows]))
+        self.blocks['embedding'].append(
+            _features_to_storage(chunk[:, :, N_ENCODING:N_FEATURES][rows], self.dtype))
+        self.blocks['labels'].append(encode_labels(chunk[:, :, N_FEATURES:][rows]))
+        self.blocks['extra'].append(
+            chunk[:, :, N_FEATURES + N_Q8 + 1:][rows].astype(np.float32))
+        self.lengths.append(lengths)
+        self.n_proteins += len(chunk)
+
+    def flush(self):
+        """ Writes the current shard to disk """
+        if not self.n_proteins:
+            return
+
+        name = f'shard-{len(self.shards):05d}'
+        shard_path = ensure_exists(self.output / name)
+
+        lengths = np.concatenate(self.lengths)
+        arrays = {
+            'lengths': lengths.astype(np.int32),
+            'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            **{key: np.concatenate(block) for key, block in self.blocks.items()}
+        }
+        if not arrays['extra'].shape[1]:
+            del arrays['extra']
+
+        files = {}
+        for key, array in arrays.items():
+            np.save(shard_path / f'{key}.npy', array)
+            files[f'{key}.npy'] = file_hash(shard_path / f'{key}.npy')
+
+        self.shards.append({
+            'path': name,
+            'proteins': int(len(lengths)),
+            'residues': int(lengths.sum()),
+            'extra_labels': int(self.blocks['extra'][0].shape[1]),
+            'files': files
+        })
+        self._reset()
+
+
+def convert_dataset(paths: list, output: str, dtype: str = 'float32',
+                        shard_size: int = 1000) -> dict:
+    """ Converts datasets into sharded directories of uncompressed, packed arrays.
+    Each shard stores the amino acids as uint8 indices, the embedding in the given
+    precision, the mask, Q8 and Q3 classes as int8 and the lengths and offsets of its
+    proteins.
+    Args:
+        paths: file paths of the datasets, their proteins are written in order
+        output: directory of the converted dataset
+        dtype: precision of the embedding, 'float32', 'float16' or 'bfloat16'
+        shard_size: number of proteins per shard
+    Returns:
+        the manifest of the converted dataset
+    """
+    if dtype not in CONVERT_DTYPES:
+        raise ValueError(f'Unknown dtype "{dtype}", '
+                            f'expected one of {list(CONVERT_DTYPES)}')
+
+    output = ensure_exists(output)
+    writer = _ShardWriter(output, dtype, shard_size)
+
+    sources = []
+    for path in paths:
+        log.info(f'Converting {path}')
+        for _, chunk in iter_proteins(path):
+            writer.add(chunk)
+        sources.append({'path': str(path), 'sha256': file_hash(path)})
+    writer.flush()
+
+    manifest = {
+        'version': FORMAT_VERSION,
+        'dtype': dtype,
+        'channels': {
+            'residues': [0, N_ENCODING],
+            'embedding': [N_ENCODING, N_FEATURES]
+        },
+        'labels': ['mask', 'q8', 'q3'],
+        'proteins': sum(shard['proteins'] for shard in writer.shards),
+        'residues': sum(shard['residues'] for shard in writer.shards),
+        'shards': writer.shards,
+        'sources': sources
+    }
+
+    # the manifest is written last, so a dataset is only detected once complete
+    tmp_path = output / (MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp_path, output / MANIFEST)
+
+    return manifest
+
+
+class ConvertedDataset:
+    """ Reads the proteins of a dataset written by convert_dataset """
+
+    def __init__(self, path: str, channels: slice = slice(0, N_FEATURES),
+                    mmap: bool = True, compact: bool = False):
+        """ Constructor
+        Args:
+            path: directory of the converted dataset
+            channels: feature channels to read, only their blocks are opened
+            mmap: memory-maps the blocks instead of loading them
+            compact: returns the encoded mask, Q8 and Q3 labels instead of decoding them
+        """
+        self.path = Path(path)
+        self.manifest = read_manifest(path)
+        self.dtype = self.manifest['dtype']
+        self.mmap_mode = 'r' if mmap else None
+        self.compact = compact
+
+        # split the channels into the encoding and embedding blocks
+        self.encoding, self.embedding = split_channels(channels)
+        self.n_features = len(range(N_FEATURES)[channels])
+        if compact:
+            self.n_labels = 3
+        else:
+            shards = self.manifest['shards']
+            self.n_labels = 1 + N_Q8 + (shards[0]['extra_labels'] if shards else 0)
+
+        self._open_shards()
+
+        lengths = [np.load(self.path / shard['path'] / 'lengths.npy')
+                    for shard in self.manifest['shards']]
+        counts = [len(shard_lengths) for shard_lengths in lengths]
+        self.lengths = np.concatenate(lengths).astype(np.int64)
+        self.shard_index = np.repeat(np.arange(len(self.shards)), counts)
+        self.shard_start = np.concatenate([[0], np.cumsum(counts)])
+
+    def _open_shards(self):
+        """ Loads the blocks of all shards into memory, memory-mapped blocks are only
+        opened once a protein of their shard is read
+        """
+        self.shards = [None if self.mmap_mode else self._open(shard)
+                        for shard in self.manifest['shards']]
+
+    def _shard(self, shard_idx: int) -> dict:
+        """ Returns the blocks of a shard, opening them if they are not open """
+        if self.shards[shard_idx] is None:
+            self.shards[shard_idx] = self._open(self.manifest['shards'][shard_idx])
+
+        return self.shards[shard_idx]
+
+    @property
+    def open_shards(self) -> list:
+        """ Returns the indices of the shards whose blocks are open """
+        return [shard_idx for shard_idx, shard in enumerate(self.shards)
+                if shard is not None]
+
+    def release(self):
+        """ Closes the blocks of all shards, they reopen when a protein is read """
+        self.shards = [None] * len(self.shards)
+
+    def __getstate__(self) -> dict:
+        """ Returns the state sent to the workers, without the memory-mapped blocks """
+        state = self.__dict__.copy()
+        if self.mmap_mode:
+            state['shards'] = None
+
+        return state
+
+    def __setstate__(self, state: dict):
+        """ Restores the state in a worker and reopens the memory-mapped blocks """
+        self.__dict__.update(state)
+        if self.mmap_mode:
+            self._open_shards()
+
+    def _open(self, shard: dict) -> dict:
+        """ Opens the blocks of a shard that are needed for the channels """
+        path = self.path / shard['path']
+        keys = ['offsets', 'labels']
+        if self.encoding.stop > self.encoding.start:
+            keys.append('residues')
+        if self.embedding.stop > self.embedding.start:
+            keys.append('embedding')
+        if shard['extra_labels'] and not self.compact:
+            keys.append('extra')
+
+        return {
+            key: np.load(path / f'{key}.npy',
+                            mmap_mode=None if key == 'offsets' else self.mmap_mode)
+            for key in keys
+        }
+
+    def __getitem__(self, index: int) -> (torch.tensor, torch.tensor):
+        """ Returns the input and labels of a protein
+        Args:
+            index: index of the protein
+        """
+        shard = self._shard(self.shard_index[index])
+        local = index - self.shard_start[self.shard_index[index]]
+        rows = slice(int(shard['offsets'][local]), int(shard['offsets'][local + 1]))
+
+        return self._features(shard, rows), self._labels(shard, rows)
+
+    def gather(self, indices: np.ndarray, X: torch.tensor, y: torch.tensor):
+        """ Writes the inputs and labels of several proteins into padded batch tensors,
+        reading the rows of each shard at once
+        Args:
+            indices: indices of the proteins
+            X: zeroed (proteins, residues, channels) tensor for the inputs
+            y: zeroed (proteins, residues, channels) tensor for the labels
+        """
+        n_proteins, n_residues = X.shape[:2]
+        positions = np.arange(n_residues)
+        valid = positions < self.lengths[indices][:, None]
+
+        # protein and position in the batch of every row that is read
+        protein = np.broadcast_to(np.arange(n_proteins)[:, None], valid.shape)[valid]
+        position = np.broadcast_to(positions, valid.shape)[valid]
+        shard_index = self.shard_index[indices][protein]
+        local = indices[protein] - self.shard_start[shard_index]
+        target = protein * n_residues + position
+
+        X, y = X.view(-1, X.shape[-1]), y.view(-1, y.shape[-1])
+        for shard_idx in np.unique(shard_index):
+            selected = shard_index == shard_idx
+            shard = self._shard(shard_idx)
+            rows = shard['offsets'][local[selected]] + position[selected]
+
+            rows_target = torch.from_numpy(target[selected])
+
+            X[rows_target] = self._features(shard, rows).to(X.dtype)
+            y[rows_target] = self._labels(shard, rows)
+
+    def _features(self, shard: dict, rows: slice) -> torch.tensor:
+        """ Returns the input channels of the rows, with one-hot amino acids """
+        features = []
+        if 'residues' in shard:
+            residues = torch.from_numpy(np.array(shard['residues'][rows]))
+            features.append(decode_residues(residues, self.encoding))
+        if 'embedding' in shard:
+            embedding = shard['embedding'][rows, self.embedding]
+            features.append(_features_from_storage(embedding, self.dtype))
+
+        dtype = features[-1].dtype if 'embedding' in shard else torch.float32
+        return torch.cat([feature.to(dtype) for feature in features], dim=1)
+
+    def _labels(self, shard: dict, rows: slice) -> torch.tensor:
+        """ Returns the labels of the rows in the layout of the dataset files, or the
+        encoded labels if compact
+        """
+        labels = torch.from_numpy(np.array(shard['labels'][rows]))
+        if self.compact:
+            return labels
+
+        extra = None
+        if 'extra' in shard:
+            extra = torch.from_numpy(np.array(shard['extra'][rows]))
+
+        return decode_labels(labels, extra)
+
+    def __len__(self):
+        return len(self.lengths)
@@ -1,17 +1,16 @@
-import warnings
-
-try:
-    from torch.utils.tensorboard import SummaryWriter
-except ImportError:
-    warnings.warn("Import `from torch.utils.tensorboard import SummaryWriter` \
-        failed. Ensure PyTorch version >= 1.1 and Tensorboard > 1.14 are installed. \
-             Training wont work", ImportWarning)
-
-
 class TensorboardWriter:
     def __init__(self, writer_dir, enabled):
         self.writer = None
         if enabled:
+            # tensorboard is imported only when a writer is enabled, it is slow to
+            # import and only needed for training
+            try:
+                from torch.utils.tensorboard import SummaryWriter
+            except ImportError:
+                raise ImportError("Import `from torch.utils.tensorboard import "
+                                    "SummaryWriter` failed. Ensure PyTorch version >= "
+                                    "1.1 and Tensorboard > 1.14 are installed, or "
+                                    "disable tensorboard in the configuration")
             self.writer = SummaryWriter(writer_dir)
 
         self.step = 0